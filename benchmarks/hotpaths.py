@@ -0,0 +1,229 @@
+"""Микробенчмарки чистого Python-кода, который выполняется на каждом ходе диалога.
+
+Для каждого случая измеряются ops/sec (лучший из нескольких повторов) и пиковый
+объем памяти, выделенной за один вызов (tracemalloc). Результаты сохраняются в
+JSON как базовая линия; при сравнении прогон падает с кодом 1, если ops/sec
+упали или выделения выросли больше допуска.
+
+    python -m benchmarks.hotpaths --save benchmarks/baseline.json
+    python -m benchmarks.hotpaths --compare benchmarks/baseline.json
+
+Ответы 2ГИС генерируются детерминированно в формате catalog API 3.0; записанные
+ответы можно подложить через --payloads DIR (каждый *.json - отдельный случай).
+Базовую линию стоит сравнивать только на той же машине и версии Python.
+"""
+import os
+
+# Модули состояния создают глобальные объекты из настроек при импорте
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("STATE_DB_PATH", "")
+
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Coroutine, Dict, List, Optional
+
+from root_packages.api import GISClient, OpenAIClient, UserPreferences
+from root_packages.api.openai_client import sanitize_user_message
+from root_packages.state.user_state import UserStateManager
+
+
+PAYLOAD_SIZES = (10, 100, 500)
+
+RUBRICS = ["Кафе", "Рестораны", "Кофейни", "Бары", "Пиццерии", "Суши-бары", "Кинотеатры", "Музеи"]
+STREETS = ["Тверская", "Арбат", "Мясницкая", "Покровка", "Пятницкая", "Никольская"]
+
+
+def make_payload(size: int, seed: int = 42) -> Dict:
+    """Ответ /3.0/items с полями, которые запрашивает GISClient."""
+    rng = random.Random(seed)
+    items = []
+    for i in range(size):
+        street = rng.choice(STREETS)
+        items.append({
+            "id": f"70000001{seed:04d}{i:06d}",
+            "type": "branch",
+            "name": f"Заведение №{i} на {street}",
+            "address_name": f"{street} улица, {rng.randint(1, 120)}",
+            "point": {"lat": 55.75 + rng.uniform(-0.05, 0.05), "lon": 37.62 + rng.uniform(-0.08, 0.08)},
+            "adm_div": [
+                {"type": "country", "name": "Россия"},
+                {"type": "city", "name": "Москва"},
+                {"type": "district", "name": f"{rng.choice(['Тверской', 'Басманный', 'Пресненский'])} район"},
+            ],
+            "rubrics": [{"id": str(rng.randint(100, 999)), "name": name, "kind": "primary"}
+                        for name in rng.sample(RUBRICS, rng.randint(1, 3))],
+            "reviews": {"rating": round(rng.uniform(3.0, 5.0), 1), "count": rng.randint(0, 3000)},
+            "contact_groups": [{"contacts": [{"type": "phone", "value": f"+7495{rng.randint(1000000, 9999999)}"}]}],
+            "schedule": {day: {"working_hours": [{"from": "10:00", "to": "23:00"}]}
+                         for day in ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")},
+        })
+    return {"meta": {"code": 200}, "result": {"total": size * 3, "items": items}}
+
+
+def run_sync(coroutine: Coroutine) -> Any:
+    """Выполняет корутину без ожиданий внутри, не создавая event loop."""
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("coroutine awaited something")
+
+
+def build_cases(payload_dir: Optional[str] = None) -> Dict[str, Callable[[], Any]]:
+    gis_client = GISClient("benchmark")
+    openai_client = OpenAIClient("benchmark")
+    preferences = UserPreferences(
+        category="кафе",
+        price_range="средний",
+        activity_type="еда",
+        time_preference="вечером",
+        specific_requirements=["веранда", "wifi"]
+    )
+    location = {"lat": 55.7558, "lon": 37.6173}
+
+    payloads = {f"parse_places[{size}]": make_payload(size) for size in PAYLOAD_SIZES}
+    if payload_dir:
+        for path in sorted(Path(payload_dir).glob("*.json")):
+            payloads[f"parse_places[{path.stem}]"] = json.loads(path.read_text(encoding="utf-8"))
+    place = gis_client._parse_places(payloads["parse_places[10]"])[0]
+
+    short_message = "хочу в недорогое кафе вечером"
+    long_message = "Хочу найти уютное место, где можно поужинать с друзьями! " * 12
+
+    # Длинная история: заполнено окно history_size и уже есть свернутое содержание
+    state = UserStateManager(history_size=50, history_token_budget=10 ** 9)
+    user_id = 1
+    for i in range(50):
+        state.add_message(user_id, "user" if i % 2 else "assistant", f"Реплика номер {i}: {short_message}")
+    state.set_summary(user_id, "Ранее пользователь сообщил: категория - кафе; бюджет - средний.")
+
+    cases: Dict[str, Callable[[], Any]] = {
+        "sanitize_user_message[short]": lambda: sanitize_user_message(short_message),
+        "sanitize_user_message[long]": lambda: sanitize_user_message(long_message),
+        "build_search_params": lambda: gis_client._build_search_params(preferences, location, 5000, 30, "rating"),
+        "format_place_for_user": lambda: gis_client.format_place_for_user(place),
+        "get_conversation_history[50]": lambda: state.get_conversation_history(user_id),
+        "should_start_search": lambda: run_sync(openai_client.should_start_search(preferences)),
+    }
+    for name, payload in payloads.items():
+        cases[name] = lambda payload=payload: gis_client._parse_places(payload)
+    return cases
+
+
+def measure_ops(fn: Callable[[], Any], min_time: float, repeat: int) -> float:
+    # Подбираем число вызовов так, чтобы один замер длился не меньше min_time
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - started)
+    return number / best
+
+
+def measure_alloc(fn: Callable[[], Any]) -> int:
+    fn()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - baseline
+
+
+def run(cases: Dict[str, Callable[[], Any]], min_time: float, repeat: int, selected: List[str]) -> Dict:
+    results = {}
+    for name, fn in cases.items():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        gc.collect()
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            ops = measure_ops(fn, min_time, repeat)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        results[name] = {"ops_per_sec": round(ops, 1), "alloc_bytes": measure_alloc(fn)}
+        print(f"{name:<36}{ops:>14,.0f} ops/s{results[name]['alloc_bytes']:>12,} B")
+    return {
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}",
+        "results": results
+    }
+
+
+def compare(report: Dict, baseline: Dict, ops_tolerance: float, alloc_tolerance: float) -> List[str]:
+    if (report["python"], report["machine"]) != (baseline.get("python"), baseline.get("machine")):
+        print(f"Внимание: базовая линия снята на Python {baseline.get('python')} ({baseline.get('machine')})")
+
+    failures = []
+    for name, base in baseline.get("results", {}).items():
+        current = report["results"].get(name)
+        if current is None:
+            continue
+        ops_ratio = current["ops_per_sec"] / base["ops_per_sec"]
+        if ops_ratio < 1 - ops_tolerance:
+            failures.append(f"{name}: {current['ops_per_sec']:,.0f} ops/s против {base['ops_per_sec']:,.0f} ({ops_ratio - 1:+.0%})")
+        # Небольшой абсолютный запас: мелкие выделения колеблются на десятки байт
+        if current["alloc_bytes"] > base["alloc_bytes"] * (1 + alloc_tolerance) + 256:
+            failures.append(f"{name}: {current['alloc_bytes']:,} B выделено против {base['alloc_bytes']:,} B")
+    return failures
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей бота")
+    parser.add_argument("--save", default="", help="сохранить результаты как базовую линию")
+    parser.add_argument("--compare", default="", help="сравнить с базовой линией и упасть при регрессии")
+    parser.add_argument("--payloads", default="", help="каталог с записанными ответами 2ГИС (*.json)")
+    parser.add_argument("--ops-tolerance", type=float, default=0.15, help="допустимое падение ops/sec")
+    parser.add_argument("--alloc-tolerance", type=float, default=0.10, help="допустимый рост выделений памяти")
+    parser.add_argument("--min-time", type=float, default=0.2, help="минимальная длительность одного замера, с")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-k", dest="selected", action="append", default=[], help="запускать только случаи с подстрокой")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    report = run(build_cases(args.payloads), args.min_time, args.repeat, args.selected)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"Базовая линия сохранена в {args.save}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        failures = compare(report, baseline, args.ops_tolerance, args.alloc_tolerance)
+        if failures:
+            print("Регрессии:")
+            for failure in failures:
+                print(f"  {failure}")
+            return 1
+        print("Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,147 @@
+import os
 import sys
 import asyncio
+import secrets
 import logging
 
-from root_packages.root import bot
-from root_packages.handlers.akinator_handler import dp
+from root_packages.root import bot, outbound_queue
+from root_packages.handlers.akinator_handler import dp, gis_client, place_index, popular_places, user_queue
+from root_packages.metrics import LoopLagMonitor, MetricsServer
+from root_packages.sharding import ShardSupervisor, build_supervisor_app, run_polling_supervisor
+from root_packages.state import state_manager
+from root_packages.webhook import load_ssl_context, register_webhook, run_shard_worker, run_webhook, serve_app
+from settings import settings
+
+
+metrics_server = MetricsServer(settings.metrics.host, settings.metrics.port, settings.metrics.path)
+loop_lag_monitor = LoopLagMonitor(settings.metrics.loop_lag_interval)
+
+
+async def on_startup() -> None:
+    await gis_client.start()
+    await place_index.start()
+    if gis_client.popular_places is not None:
+        await popular_places.start(gis_client.fetch_popular)
+    await state_manager.start()
+    if settings.metrics.enabled:
+        await metrics_server.start()
+        await loop_lag_monitor.start()
+
+
+async def on_shutdown() -> None:
+    # Фоновые поиски пишут в сессии, поэтому останавливаются до клиентов и хранилища
+    await user_queue.close()
+    # Фоновое обновление тайлов ходит в 2ГИС: сначала оно, затем пул соединений
+    await popular_places.close()
+    await gis_client.close()
+    await place_index.close()
+    await state_manager.close()
+    await loop_lag_monitor.close()
+    await metrics_server.close()
+    await outbound_queue.close()
+
+
+def run_shard(index: int, port: int, secret_token: str) -> None:
+    """Точка входа процесса-воркера в режиме шардирования."""
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stdout,
+        format=f"[shard {index}] %(levelname)s:%(name)s:%(message)s"
+    )
+    # У каждого воркера свой порт метрик, чтобы они не конфликтовали
+    metrics_server.port = settings.metrics.port + 1 + index
+    # Лимит Telegram общий на бота, поэтому делится между воркерами
+    outbound_queue.global_rate = settings.outbound.global_rate / settings.sharding.workers
+    # Индексы шардов содержат разные места, поэтому снимок у каждого свой.
+    # База сессий общая: строки разных пользователей не пересекаются
+    if place_index.snapshot_path:
+        base, ext = os.path.splitext(place_index.snapshot_path)
+        place_index.snapshot_path = f"{base}.shard{index}{ext}"
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    asyncio.run(run_shard_worker(
+        dp, bot,
+        port=port,
+        path=settings.webhook.path,
+        health_path=settings.webhook.health_path,
+        secret_token=secret_token,
+        queue_size=settings.webhook.queue_size
+    ))
+
+
+async def run_sharded() -> None:
+    supervisor = ShardSupervisor(
+        run_shard,
+        shards=settings.sharding.workers,
+        base_port=settings.sharding.base_port,
+        path=settings.webhook.path,
+        health_path=settings.webhook.health_path,
+        # Внутренний токен: воркеры принимают обновления только от супервизора
+        secret_token=secrets.token_urlsafe(16),
+        heartbeat_interval=settings.sharding.heartbeat_interval,
+        heartbeat_timeout=settings.sharding.heartbeat_timeout,
+        startup_timeout=settings.sharding.startup_timeout,
+        restart_delay=settings.sharding.restart_delay,
+        restart_delay_max=settings.sharding.restart_delay_max,
+        queue_size=settings.sharding.queue_size,
+        overflow_size=settings.sharding.overflow_size
+    )
+    allowed_updates = dp.resolve_used_update_types()
+    
+    if settings.webhook.mode != "webhook":
+        await run_polling_supervisor(supervisor, bot, allowed_updates)
+        return
+    
+    await register_webhook(
+        bot,
+        settings.webhook.base_url,
+        settings.webhook.path,
+        allowed_updates,
+        secret_token=settings.webhook.secret_token,
+        cert_path=settings.webhook.cert_path
+    )
+    await supervisor.start()
+    try:
+        await serve_app(
+            build_supervisor_app(
+                supervisor,
+                settings.webhook.path,
+                settings.webhook.health_path,
+                settings.webhook.secret_token
+            ),
+            settings.webhook.host,
+            settings.webhook.port,
+            load_ssl_context(settings.webhook.cert_path, settings.webhook.key_path)
+        )
+    finally:
+        await supervisor.close()
+        await bot.session.close()
 
 
 async def main() -> None:
-    await dp.start_polling(bot)
+    if settings.sharding.workers > 1:
+        await run_sharded()
+        return
+    
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    
+    if settings.webhook.mode == "webhook":
+        await run_webhook(
+            dp, bot,
+            base_url=settings.webhook.base_url,
+            host=settings.webhook.host,
+            port=settings.webhook.port,
+            path=settings.webhook.path,
+            health_path=settings.webhook.health_path,
+            secret_token=settings.webhook.secret_token,
+            cert_path=settings.webhook.cert_path,
+            key_path=settings.webhook.key_path,
+            queue_size=settings.webhook.queue_size
+        )
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lon: float, precision: int = 6) -> str:
+    """Кодирует точку в geohash заданной длины (6 символов ~ 1.2 x 0.6 км)."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    result = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(result) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            result.append(_GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(result)
+
+
+def geohash_center(geohash: str) -> Tuple[float, float]:
+    """Центр ячейки geohash как (lat, lon)."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for char in geohash:
+        bits = _GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            bit = (bits >> shift) & 1
+            target = lon_range if even else lat_range
+            target[1 - bit] = (target[0] + target[1]) / 2
+            even = not even
+
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+class TTLCache:
+    """LRU-кэш с TTL, ограниченный числом записей и (опционально) объемом в байтах."""
+
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int = 1000,
+        max_bytes: int = 0,
+        sizeof: Optional[Callable[[Any], int]] = None
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 1)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires_at, size = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if key in self._data:
+            self._remove(key)
+
+        size = self.sizeof(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        self._data[key] = (value, time.monotonic() + self.ttl, size)
+        self.current_bytes += size
+
+        while self._data and (
+            len(self._data) > self.max_entries
+            or (self.max_bytes and self.current_bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._data),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._data.pop(key)
+        self.current_bytes -= size
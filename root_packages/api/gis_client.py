@@ -1,9 +1,17 @@
 import aiohttp
 import logging
 import ssl
-from typing import Dict, List, Optional, Any
+import sys
+from typing import TYPE_CHECKING, Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass
 from .openai_client import UserPreferences
+from .cache import TTLCache, geohash_encode
+from .singleflight import SingleFlight
+from .upstream import Upstream, UpstreamError, parse_retry_after
+
+if TYPE_CHECKING:
+    from .place_index import PlaceIndex
+    from .popular_places import PopularPlaces
 
 
 @dataclass
@@ -18,37 +26,235 @@ class Place:
     card2gis: str
 
 
+CATEGORY_MAPPING = {
+    "ресторан": "restaurant",
+    "кафе": "cafe",
+    "развлечения": "entertainment",
+    "спорт": "sport",
+    "культура": "culture",
+    "шоппинг": "shopping",
+    "красота": "beauty",
+    "услуги": "service"
+}
+
+
+CATEGORY_NAMES = {english: russian for russian, english in CATEGORY_MAPPING.items()}
+
+# Запрос, с которым ищем места, когда у пользователя нет конкретных предпочтений
+POPULAR_QUERY = "популярные места"
+
+
+def _estimate_places_size(places: List[Place]) -> int:
+    # Грубая оценка: строки и списки рубрик доминируют в размере записи
+    size = sys.getsizeof(places)
+    for place in places:
+        size += sys.getsizeof(place) + sys.getsizeof(place.name) + sys.getsizeof(place.address)
+        size += sys.getsizeof(place.card2gis) + sum(sys.getsizeof(c) for c in place.categories)
+    return size
+
+
 class GISClient:
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 30,
+        keepalive_timeout: float = 30.0,
+        dns_cache_ttl: int = 300,
+        cache_ttl: float = 600.0,
+        cache_max_entries: int = 5000,
+        cache_max_bytes: int = 0,
+        cache_geohash_precision: int = 6,
+        upstream: Optional[Upstream] = None,
+        place_index: Optional["PlaceIndex"] = None,
+        serve_from_index: bool = False,
+        popular_places: Optional["PopularPlaces"] = None
+    ):
         self.api_key = api_key
         self.base_url = "https://catalog.api.2gis.com/3.0/items"
         self.ssl_context = ssl.create_default_context()
         self.ssl_context.check_hostname = False
         self.ssl_context.verify_mode = ssl.CERT_NONE
-        
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session: Optional[aiohttp.ClientSession] = None
+        # После close() сессия не открывается заново поздними запросами
+        self._closed = False
+        self.cache_geohash_precision = cache_geohash_precision
+        self.cache = TTLCache(
+            ttl=cache_ttl,
+            max_entries=cache_max_entries,
+            max_bytes=cache_max_bytes,
+            sizeof=_estimate_places_size
+        )
+        self._flight = SingleFlight()
+        self.upstream = upstream or Upstream("2gis")
+        # Индекс уже виденных мест: запасной источник при сбоях 2ГИС и, если
+        # serve_from_index включен, ответ без запроса, когда индекс покрывает поиск
+        self.place_index = place_index
+        self.serve_from_index = serve_from_index
+        # Поиск без критериев отвечается из заранее обновляемых списков по тайлам
+        self.popular_places = popular_places
+
+    async def start(self) -> None:
+        """Открывает общую сессию с пулом соединений к 2ГИС."""
+        self._closed = False
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            limit_per_host=self.connection_limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            ssl=self.ssl_context
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._closed:
+            raise RuntimeError("GISClient is closed")
+        # Сессия создается лениво, если клиент используется без start()
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+
     async def search_places(
         self, 
         user_preferences: UserPreferences,
         location: Optional[Dict[str, float]] = None,
         radius: int = 2000,
         limit: int = 10,
-        sort: str = 'rating'
+        sort: str = 'rating',
+        query: Optional[str] = None,
+        page: int = 1
     ) -> List[Place]:
-        params = self._build_search_params(user_preferences, location, radius, limit, sort)
+        """Поиск мест; query заменяет запрос, собранный из предпочтений."""
+        params = self._build_search_params(user_preferences, location, radius, limit, sort, query)
+        if page > 1:
+            params["page"] = page
+        cache_key = self._cache_key(params)
         
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(self.base_url, params=params, ssl=self.ssl_context) as response:
-                    if response.status != 200:
-                        logging.error(f"2GIS API error: {response.status}")
-                        return []
-                    
-                    data = await response.json()
-                    return self._parse_places(data)
-                    
-            except Exception as e:
-                logging.error(f"Error searching places: {e}")
-                return []
+        popular = (
+            self.popular_places is not None and page == 1 and bool(location)
+            and params["q"] == POPULAR_QUERY and self.popular_places.covers(radius, limit, sort)
+        )
+        if popular:
+            places = self.popular_places.get(location, limit)
+            if places is not None:
+                return places
+            # Живой поиск заполнит тайл для всех его пользователей, поэтому идет от центра тайла
+            params = self._build_search_params(
+                user_preferences, self.popular_places.center(location), radius, limit, sort, query
+            )
+            cache_key = self._cache_key(params)
+        
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+        
+        if self.serve_from_index and page == 1:
+            local = self._search_index(user_preferences, location, radius, limit, query)
+            if len(local) >= limit:
+                return local
+        
+        # Одинаковые одновременные запросы выполняются одним обращением к API
+        places = await self._flight.do(cache_key, lambda: self._fetch_and_cache(cache_key, params))
+        if places is None:
+            # 2ГИС недоступен или превышена квота: отвечаем из локального индекса
+            return self._search_index(user_preferences, location, radius, limit, query) if page == 1 else []
+        if popular:
+            self.popular_places.put(location, places)
+        return list(places)
+
+    async def fetch_popular(
+        self,
+        location: Dict[str, float],
+        radius: int,
+        limit: int,
+        sort: str
+    ) -> Optional[List[Place]]:
+        """Живой запрос популярных мест у точки для фонового обновления PopularPlaces."""
+        params = self._build_search_params(UserPreferences(), location, radius, limit, sort, query="")
+        places = await self._fetch_and_cache(self._cache_key(params), params)
+        return None if places is None else list(places)
+
+    def _search_index(
+        self,
+        preferences: UserPreferences,
+        location: Optional[Dict[str, float]],
+        radius: int,
+        limit: int,
+        query: Optional[str]
+    ) -> List[Place]:
+        if self.place_index is None or not location:
+            return []
+        
+        if query is None:
+            terms = [preferences.category, preferences.activity_type, *(preferences.specific_requirements or [])]
+        else:
+            # В запросе категории записаны по-английски, а рубрики в индексе - по-русски
+            terms = [CATEGORY_NAMES.get(term, term) for term in query.split()]
+        return self.place_index.query([term for term in terms if term], location, radius, limit)
+
+    async def _fetch_and_cache(self, cache_key: Tuple, params: Dict[str, Any]) -> Optional[Tuple[Place, ...]]:
+        places = await self._fetch(params)
+        if places is None:
+            return None
+        
+        places = tuple(places)
+        self.cache.set(cache_key, places)
+        if self.place_index is not None:
+            self.place_index.add(places)
+        return places
+
+    async def _fetch(self, params: Dict[str, Any]) -> Optional[List[Place]]:
+        # None означает ошибку запроса: такие ответы не кэшируются
+        try:
+            data = await self.upstream.call(lambda: self._request(params))
+            if data is None:
+                return None
+            return self._parse_places(data)
+                
+        except Exception as e:
+            logging.error(f"Error searching places: {e}")
+            return None
+
+    async def _request(self, params: Dict[str, Any]) -> Optional[Dict]:
+        session = await self._get_session()
+        async with session.get(self.base_url, params=params) as response:
+            if response.status == 429 or response.status >= 500:
+                raise UpstreamError(response.status, parse_retry_after(response.headers.get("Retry-After")))
+            if response.status != 200:
+                logging.error(f"2GIS API error: {response.status}")
+                return None
+            
+            return await response.json()
+
+    def _cache_key(self, params: Dict[str, Any]) -> Tuple:
+        """Нормализованный ключ запроса: точка привязывается к ячейке geohash."""
+        cell = None
+        if "point" in params:
+            lon, lat = (float(v) for v in params["point"].split(","))
+            cell = geohash_encode(lat, lon, self.cache_geohash_precision)
+        
+        terms = tuple(sorted(params.get("q", "").lower().split()))
+        return (
+            terms,
+            params.get("sort"),
+            params.get("page_size"),
+            params.get("radius"),
+            params.get("page", 1),
+            cell
+        )
 
     def _build_search_params(
         self, 
@@ -56,8 +262,8 @@ class GISClient:
         location: Optional[Dict[str, float]],
         radius: int, 
         limit: int,
-        sort: str
-
+        sort: str,
+        query: Optional[str] = None
     ) -> Dict[str, Any]:
         params = {
             "fields": "items.point,items.adm_div,items.contact_groups,items.rubrics,items.reviews,items.schedule",
@@ -73,21 +279,24 @@ class GISClient:
             params["point"] = f"{location['lon']},{location['lat']}"
             params["radius"] = radius
         # Формируем поисковый запрос на основе предпочтений
+        if query is None:
+            query_parts = self._build_query_terms(preferences)
+            query = " ".join(query_parts)
+        
+        if query:
+            params["q"] = query
+        else:
+            # Если нет конкретных предпочтений, ищем популярные места
+            params["q"] = POPULAR_QUERY
+            
+        return params
+
+    def _build_query_terms(self, preferences: UserPreferences) -> List[str]:
         query_parts = []
         
         if preferences.category:
-            category_mapping = {
-                "ресторан": "restaurant",
-                "кафе": "cafe",
-                "развлечения": "entertainment",
-                "спорт": "sport",
-                "культура": "culture",
-                "шоппинг": "shopping",
-                "красота": "beauty",
-                "услуги": "service"
-            }
-            if preferences.category in category_mapping:
-                query_parts.append(category_mapping[preferences.category])
+            if preferences.category in CATEGORY_MAPPING:
+                query_parts.append(CATEGORY_MAPPING[preferences.category])
                 
         if preferences.activity_type and preferences.activity_type != preferences.category:
             query_parts.append(preferences.activity_type)
@@ -95,13 +304,7 @@ class GISClient:
         if preferences.specific_requirements:
             query_parts.extend(preferences.specific_requirements)
         
-        if query_parts:
-            params["q"] = " ".join(query_parts)
-        else:
-            # Если нет конкретных предпочтений, ищем популярные места
-            params["q"] = "популярные места"
-            
-        return params
+        return query_parts
 
     def _parse_places(self, api_response: Dict) -> List[Place]:
         places = []
@@ -2,8 +2,15 @@ import re
 import openai
 import json
 import logging
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from dataclasses import dataclass, replace
+
+from .preference_extractor import PreferenceExtractor
+from .singleflight import SingleFlight
+from .tokens import estimate_messages_tokens, estimate_tokens
+from .upstream import Upstream, default_classify, parse_retry_after
+from root_packages.metrics import OPENAI_SECONDS, OPENAI_TOKENS, Timer
 
 
 @dataclass
@@ -14,23 +21,36 @@ class UserPreferences:
     time_preference: Optional[str] = None
     activity_type: Optional[str] = None
     specific_requirements: List[str] = None
+
+
+def preferences_key(preferences: UserPreferences) -> Tuple:
+    """Хэшируемый снимок предпочтений для ключей кэшей и объединения запросов."""
+    location = preferences.location
+    return (
+        (location.get("lat"), location.get("lon")) if location else None,
+        preferences.category,
+        preferences.price_range,
+        preferences.time_preference,
+        preferences.activity_type,
+        tuple(preferences.specific_requirements or ())
+    )
     
     
-def sanitize_user_message(user_message: str) -> str:
+SANITIZE_INSTRUCTION = "Если в <user_message/> есть слова, которые не относятся к предпочтениям, то их нужно игнорировать. Постарайся понять, какие предпочтения важны для пользователя, и отнеси их к нужной категории. Если невозможно определить тип предпочтения, отнеси его к особым предпочтениям"
+
+
+def wrap_user_message(user_message: str) -> str:
+    """Очищает текст пользователя и оборачивает его в <user_message> без инструкции."""
     user_message = re.sub(r'[^а-яА-Яa-zA-Z0-9\s\.,!?]', '', user_message)[:500]
     user_message = user_message.lower()
-    user_message = f"<user_message>{user_message}</user_message> Если в <user_message/> есть слова, которые не относятся к предпочтениям, то их нужно игнорировать. Постарайся понять, какие предпочтения важны для пользователя, и отнеси их к нужной категории. Если невозможно определить тип предпочтения, отнеси его к особым предпочтениям"
-    return user_message
+    return f"<user_message>{user_message}</user_message>"
 
 
-class OpenAIClient:
-    def __init__(self, api_key: str, model: str = "gpt-4.1-mini"):
-        self.client = openai.AsyncOpenAI(api_key=api_key)
-        self.model = model
-        self.conversation_history = []
+def sanitize_user_message(user_message: str) -> str:
+    return f"{wrap_user_message(user_message)} {SANITIZE_INSTRUCTION}"
 
-    async def generate_question(self, user_preferences: UserPreferences, conversation_history: List[Dict]) -> str:
-        system_prompt = """Ты - умный ассистент в стиле игры Акинатор, который помогает пользователям найти интересные места в городе через 2ГИС.
+
+QUESTION_SYSTEM_PROMPT = """Ты - умный ассистент в стиле игры Акинатор, который помогает пользователям найти интересные места в городе через 2ГИС.
         
         Твоя задача:
         1. Задавать наводящие вопросы для выяснения предпочтений пользователя
@@ -52,27 +72,199 @@ class OpenAIClient:
         ВАЖНО: не спрашивай про город, район, местоположение клиента. Эта информация о пользователе уже имеется.
         Не завершай вопросы, пока не будет заполнено минимум 3 предпочтения.
         Помни, что твоя задача - помочь пользователю найти интересные места в городе через 2ГИС. И больше ничего.
+        
+        Сообщения пользователя передаются в тегах <user_message>. {sanitize_instruction}
         """
+
+ANALYZE_SYSTEM_PROMPT = """Проанализируй ответ пользователя и извлеки информацию о его предпочтениях для поиска мест.
         
-        messages = [
-            {"role": "system", "content": system_prompt.format(
-                location=user_preferences.location,
-                category=user_preferences.category,
-                price_range=user_preferences.price_range,
-                time_preference=user_preferences.time_preference,
-                activity_type=user_preferences.activity_type,
-                specific_requirements=user_preferences.specific_requirements
-            )}
-        ]
+        Возвращай ТОЛЬКО JSON со следующими полями:
+        {
+            "category": "ресторан|кафе|развлечения|спорт|культура|шоппинг|красота|услуги|другое",
+            "price_range": "бюджетно|средний|премиум",
+            "activity_type": "еда|развлечения|спорт|культура|шоппинг|отдых|другое",
+            "time_preference": "утром|днем|вечером|ночью|выходные|будни",
+            "specific_requirements": ["список", "особых", "требований"]
+        }
         
-        for i in range(len(conversation_history)):
-            if conversation_history[i]["role"] == "user":
-                conversation_history[i]["content"] = sanitize_user_message(conversation_history[i]["content"])
-        messages.extend(conversation_history)
+        Включай только те поля, которые можно точно определить из ответа пользователя.
+        Учти всю важную информацию. Если существует важное предпочтение, тип которого не определен, относи его к особым предпочтениям.
+        """
+
+SUMMARY_SYSTEM_PROMPT = """Ты сжимаешь диалог ассистента, который подбирает места в городе, с пользователем.
+        Объедини предыдущее содержание и новые реплики в 2-3 предложения на русском языке.
+        Сохрани только то, что важно для поиска мест: пожелания, ограничения, от чего пользователь отказался.
+        """
+
+COMBINED_TURN_SUFFIX = """
+        Сначала проанализируй последнее сообщение пользователя и извлеки из него новые предпочтения,
+        затем с учетом обновленных предпочтений сформулируй следующий вопрос.
+        
+        Возвращай ТОЛЬКО JSON следующего вида:
+        {
+            "preferences": {
+                "category": "ресторан|кафе|развлечения|спорт|культура|шоппинг|красота|услуги|другое",
+                "price_range": "бюджетно|средний|премиум",
+                "activity_type": "еда|развлечения|спорт|культура|шоппинг|отдых|другое",
+                "time_preference": "утром|днем|вечером|ночью|выходные|будни",
+                "specific_requirements": ["список", "новых", "особых", "требований"]
+            },
+            "question": "следующий вопрос пользователю"
+        }
+        
+        В "preferences" включай только те поля, которые можно точно определить из последнего сообщения пользователя.
+        """
+
+
+def format_question_prompt(preferences: UserPreferences) -> str:
+    return QUESTION_SYSTEM_PROMPT.format(
+        location=preferences.location,
+        category=preferences.category,
+        price_range=preferences.price_range,
+        time_preference=preferences.time_preference,
+        activity_type=preferences.activity_type,
+        specific_requirements=preferences.specific_requirements,
+        sanitize_instruction=SANITIZE_INSTRUCTION
+    )
+
+
+def merge_preferences(current_preferences: UserPreferences, result: Dict) -> UserPreferences:
+    # Обновляем только те поля, которые были определены
+    return UserPreferences(
+        location=current_preferences.location,
+        category=result.get("category", current_preferences.category),
+        price_range=result.get("price_range", current_preferences.price_range),
+        time_preference=result.get("time_preference", current_preferences.time_preference),
+        activity_type=result.get("activity_type", current_preferences.activity_type),
+        specific_requirements=(current_preferences.specific_requirements or []) + 
+                            result.get("specific_requirements", [])
+    )
+
+
+class PromptBuilder:
+    """Собирает сообщения для модели из истории без ее изменения.
+    
+    Системный промпт рендерится один раз на снимок предпочтений и хранится в
+    LRU-кэше. История хранит исходный текст реплик; очищенная обертка
+    <user_message> строится здесь при отправке и кэшируется только для
+    недавно отправленных реплик, а не для всей истории каждой сессии.
+    """
+    
+    def __init__(self, cache_size: int = 1024, history_cache_size: int = 4096):
+        self.cache_size = cache_size
+        self.history_cache_size = history_cache_size
+        self._system_messages: "OrderedDict[Tuple, Dict]" = OrderedDict()
+        self._user_messages: "OrderedDict[str, Dict]" = OrderedDict()
+    
+    def system_message(self, preferences: UserPreferences, suffix: str = "") -> Dict:
+        key = (preferences_key(preferences), suffix)
+        message = self._system_messages.get(key)
+        if message is None:
+            message = {"role": "system", "content": format_question_prompt(preferences) + suffix}
+            self._system_messages[key] = message
+            if len(self._system_messages) > self.cache_size:
+                self._system_messages.popitem(last=False)
+        else:
+            self._system_messages.move_to_end(key)
+        return message
+    
+    def history_message(self, message: Dict) -> Dict:
+        """Сообщение истории в виде для модели: текст пользователя очищается и оборачивается."""
+        if message["role"] != "user":
+            return message
+        content = message["content"]
+        wrapped = self._user_messages.get(content)
+        if wrapped is None:
+            wrapped = {"role": "user", "content": wrap_user_message(content)}
+            self._user_messages[content] = wrapped
+            if len(self._user_messages) > self.history_cache_size:
+                self._user_messages.popitem(last=False)
+        else:
+            self._user_messages.move_to_end(content)
+        return wrapped
+    
+    def build(self, preferences: UserPreferences, history: List[Dict], suffix: str = "") -> List[Dict]:
+        return [self.system_message(preferences, suffix), *map(self.history_message, history)]
+
+
+def classify_openai_error(error: BaseException) -> Tuple[bool, Optional[float]]:
+    if isinstance(error, openai.APIStatusError):
+        status = error.status_code
+        return status == 429 or status >= 500, parse_retry_after(error.response.headers.get("retry-after"))
+    if isinstance(error, openai.APIConnectionError):
+        return True, None
+    return default_classify(error)
+
+
+def estimate_request_tokens(messages: List[Dict], max_tokens: int) -> int:
+    # Оценка для лимита токенов в минуту: промпт плюс максимальный размер ответа
+    return estimate_messages_tokens(messages) + max_tokens
+
+
+def local_summary(preferences: UserPreferences, previous_summary: str = "") -> str:
+    """Краткое содержание диалога, собранное из уже извлеченных предпочтений."""
+    parts = []
+    if preferences.category:
+        parts.append(f"категория - {preferences.category}")
+    if preferences.activity_type:
+        parts.append(f"занятие - {preferences.activity_type}")
+    if preferences.price_range:
+        parts.append(f"бюджет - {preferences.price_range}")
+    if preferences.time_preference:
+        parts.append(f"время - {preferences.time_preference}")
+    if preferences.specific_requirements:
+        parts.append(f"особые требования - {', '.join(preferences.specific_requirements)}")
+    
+    if not parts:
+        return previous_summary or "Пользователь пока не назвал конкретных предпочтений."
+    return "Ранее пользователь сообщил: " + "; ".join(parts) + "."
+
+
+class OpenAIClient:
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gpt-4.1-mini",
+        upstream: Optional[Upstream] = None,
+        extractor: Optional[PreferenceExtractor] = None,
+        summary_model: str = "",
+        timeout: Optional[float] = None
+    ):
+        # Повторы выполняет Upstream, встроенные повторы SDK отключены.
+        # timeout SDK ограничивает и паузы между чанками потокового ответа
+        self.client = openai.AsyncOpenAI(api_key=api_key, max_retries=0, timeout=timeout)
+        self.model = model
+        self.conversation_history = []
+        self.upstream = upstream or Upstream("openai", classify=classify_openai_error)
+        # Простые ответы разбираются локально, к LLM уходят только неоднозначные
+        self.extractor = extractor
+        self.prompts = PromptBuilder()
+        # Дешевая модель для сжатия истории; пустая строка - сжимать локально
+        self.summary_model = summary_model
+        self._flight = SingleFlight()
+
+    async def _create(self, **kwargs):
+        kwargs.setdefault("model", self.model)
+        tokens = estimate_request_tokens(kwargs["messages"], kwargs.get("max_tokens", 0))
+        with Timer(OPENAI_SECONDS, kwargs["model"]):
+            response = await self.upstream.call(
+                lambda: self.client.chat.completions.create(**kwargs),
+                tokens=tokens,
+                # Поток нельзя дублировать: проигравший ответ остался бы незакрытым
+                hedge=not kwargs.get("stream")
+            )
+        
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            OPENAI_TOKENS.inc(kwargs["model"], "prompt", amount=usage.prompt_tokens)
+            OPENAI_TOKENS.inc(kwargs["model"], "completion", amount=usage.completion_tokens)
+        return response
+
+    async def generate_question(self, user_preferences: UserPreferences, conversation_history: List[Dict]) -> str:
+        messages = self._build_question_messages(user_preferences, conversation_history)
         
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
+            response = await self._create(
                 messages=messages,
                 max_tokens=300,
                 temperature=0.6
@@ -82,29 +274,111 @@ class OpenAIClient:
             logging.error(f"Error generating question: {e}")
             return "Не могу сформулировать вопрос. Попробуйте еще раз."
 
-    async def analyze_user_response(self, user_message: str, current_preferences: UserPreferences) -> UserPreferences:
-        system_prompt = """Проанализируй ответ пользователя и извлеки информацию о его предпочтениях для поиска мест.
-        
-        Возвращай ТОЛЬКО JSON со следующими полями:
-        {
-            "category": "ресторан|кафе|развлечения|спорт|культура|шоппинг|красота|услуги|другое",
-            "price_range": "бюджетно|средний|премиум",
-            "activity_type": "еда|развлечения|спорт|культура|шоппинг|отдых|другое",
-            "time_preference": "утром|днем|вечером|ночью|выходные|будни",
-            "specific_requirements": ["список", "особых", "требований"]
-        }
+    def stream_question(self, user_preferences: UserPreferences, conversation_history: List[Dict]) -> AsyncIterator[str]:
+        """Потоковый вариант generate_question: отдает текст по мере генерации."""
+        messages = self._build_question_messages(user_preferences, conversation_history)
+        return self._stream_completion(
+            messages,
+            max_tokens=300,
+            temperature=0.6,
+            fallback="Не могу сформулировать вопрос. Попробуйте еще раз."
+        )
+
+    def _build_question_messages(self, user_preferences: UserPreferences, conversation_history: List[Dict]) -> List[Dict]:
+        return self.prompts.build(user_preferences, conversation_history)
+
+    async def _stream_completion(
+        self,
+        messages: List[Dict],
+        max_tokens: int,
+        temperature: float,
+        fallback: str
+    ) -> AsyncIterator[str]:
+        received = False
+        stream = None
+        completion_tokens = 0
+        try:
+            stream = await self._create(
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    received = True
+                    completion_tokens += estimate_tokens(delta)
+                    yield delta
+        except Exception as e:
+            logging.error(f"Error streaming completion: {e}")
+            # Если часть ответа уже показана, оставляем ее как есть
+            if not received:
+                yield fallback
+        finally:
+            # Потоковый ответ приходит без usage, поэтому токены оцениваются локально
+            if stream is not None:
+                OPENAI_TOKENS.inc(self.model, "prompt", amount=estimate_messages_tokens(messages))
+                OPENAI_TOKENS.inc(self.model, "completion", amount=completion_tokens)
+                # Потребитель мог остановиться на середине: закрываем HTTP-соединение потока
+                await stream.close()
+
+    async def analyze_and_ask(
+        self,
+        user_message: str,
+        current_preferences: UserPreferences,
+        conversation_history: List[Dict]
+    ) -> Tuple[UserPreferences, Optional[str]]:
+        """Один запрос на ход диалога: обновленные предпочтения и следующий вопрос.
         
-        Включай только те поля, которые можно точно определить из ответа пользователя.
-        Учти всю важную информацию. Если существует важное предпочтение, тип которого не определен, относи его к особым предпочтениям.
+        История (из UserStateManager.get_conversation_history) должна уже содержать
+        последнее сообщение пользователя. Если ответ
+        разобран локально, вопрос не генерируется и вместо него возвращается None.
         """
+        local_result = self.extractor.extract(user_message) if self.extractor else None
+        if local_result is not None:
+            return merge_preferences(current_preferences, local_result), None
+        
+        messages = self.prompts.build(current_preferences, conversation_history, suffix=COMBINED_TURN_SUFFIX)
+        
+        try:
+            response = await self._create(
+                messages=messages,
+                max_tokens=450,
+                temperature=0.5,
+                response_format={"type": "json_object"}
+            )
+            
+            result = json.loads(response.choices[0].message.content)
+            updated_preferences = merge_preferences(current_preferences, result.get("preferences") or {})
+            question = result.get("question") or "Расскажи подробнее, что бы ты хотел найти?"
+            return updated_preferences, question
+            
+        except Exception as e:
+            logging.error(f"Error analyzing user response with question: {e}")
+            return current_preferences, "Не могу сформулировать вопрос. Попробуйте еще раз."
+
+    async def analyze_user_response(self, user_message: str, current_preferences: UserPreferences) -> UserPreferences:
+        local_result = self.extractor.extract(user_message) if self.extractor else None
+        if local_result is not None:
+            return merge_preferences(current_preferences, local_result)
         
+        key = (user_message, preferences_key(current_preferences))
+        result = await self._flight.do(
+            key, lambda: self._analyze_user_response(user_message, current_preferences)
+        )
+        # Каждый ожидающий получает собственную копию, чтобы сессии не делили список
+        return replace(result, specific_requirements=list(result.specific_requirements or []))
+
+    async def _analyze_user_response(self, user_message: str, current_preferences: UserPreferences) -> UserPreferences:
         user_message = sanitize_user_message(user_message)
         
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
+            response = await self._create(
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": ANALYZE_SYSTEM_PROMPT},
                     {"role": "user", "content": user_message}
                 ],
                 max_tokens=200,
@@ -112,24 +386,40 @@ class OpenAIClient:
             )
             
             result = json.loads(response.choices[0].message.content)
-            
-            # Обновляем только те поля, которые были определены
-            updated_preferences = UserPreferences(
-                location=current_preferences.location,
-                category=result.get("category", current_preferences.category),
-                price_range=result.get("price_range", current_preferences.price_range),
-                time_preference=result.get("time_preference", current_preferences.time_preference),
-                activity_type=result.get("activity_type", current_preferences.activity_type),
-                specific_requirements=(current_preferences.specific_requirements or []) + 
-                                    result.get("specific_requirements", [])
-            )
-            
-            return updated_preferences
+            return merge_preferences(current_preferences, result)
             
         except Exception as e:
             logging.error(f"Error analyzing user response: {e}")
             return current_preferences
 
+    async def summarize_history(
+        self,
+        previous_summary: str,
+        messages: List[Dict],
+        preferences: UserPreferences
+    ) -> str:
+        """Сворачивает старые реплики в короткое содержание диалога."""
+        if not self.summary_model:
+            return local_summary(preferences, previous_summary)
+        
+        dialogue = "\n".join(
+            f"{message['role']}: {message['content']}" for message in map(self.prompts.history_message, messages)
+        )
+        try:
+            response = await self._create(
+                model=self.summary_model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": f"Предыдущее содержание: {previous_summary or 'нет'}\n\nНовые реплики:\n{dialogue}"}
+                ],
+                max_tokens=150,
+                temperature=0.2
+            )
+            return response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"Error summarizing history: {e}")
+            return local_summary(preferences, previous_summary)
+
     async def should_start_search(self, preferences: UserPreferences) -> bool:
         filled_fields = sum([
             bool(preferences.category),
@@ -142,24 +432,33 @@ class OpenAIClient:
         return filled_fields >= 5
 
     async def generate_search_refinement_question(self, search_results: List[Dict], user_message: str) -> str:
-        system_prompt = """Пользователь посмотрел результаты поиска мест и дал обратную связь. 
-        Помоги ему уточнить поиск, задав наводящий вопрос для корректировки критериев.
-        
-        Ответь кратко и дружелюбно на русском языке."""
-        
-        user_message = sanitize_user_message(user_message)
-        
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Обратная связь пользователя: {user_message}"}
-                ],
+            response = await self._create(
+                messages=self._build_refinement_messages(user_message),
                 max_tokens=200,
                 temperature=0.7
             )
             return response.choices[0].message.content
         except Exception as e:
             logging.error(f"Error generating refinement question: {e}")
-            return "Что именно вам не подходит в предложенных местах?" 
+            return "Что именно вам не подходит в предложенных местах?"
+
+    def stream_search_refinement_question(self, search_results: List[Dict], user_message: str) -> AsyncIterator[str]:
+        return self._stream_completion(
+            self._build_refinement_messages(user_message),
+            max_tokens=200,
+            temperature=0.7,
+            fallback="Что именно вам не подходит в предложенных местах?"
+        )
+
+    def _build_refinement_messages(self, user_message: str) -> List[Dict]:
+        system_prompt = """Пользователь посмотрел результаты поиска мест и дал обратную связь. 
+        Помоги ему уточнить поиск, задав наводящий вопрос для корректировки критериев.
+        
+        Ответь кратко и дружелюбно на русском языке."""
+        
+        user_message = sanitize_user_message(user_message)
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Обратная связь пользователя: {user_message}"}
+        ]
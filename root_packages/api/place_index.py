@@ -0,0 +1,179 @@
+import os
+import json
+import math
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .gis_client import Place
+
+
+EARTH_RADIUS_M = 6_371_000.0
+METERS_PER_DEGREE = 111_320.0
+
+
+def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def _stem(word: str) -> str:
+    return word[:max(4, len(word) - 2)]
+
+
+class PlaceIndex:
+    """Локальный индекс мест, уже полученных от 2ГИС.
+
+    Пространственная часть - равномерная сетка из ячеек cell_deg x cell_deg
+    градусов, текстовая - инвертированный индекс по словам названий рубрик.
+    Число мест ограничено max_places (вытесняются давно не встречавшиеся),
+    индекс периодически сохраняется в snapshot_path и загружается при старте.
+    """
+
+    def __init__(
+        self,
+        max_places: int = 50_000,
+        cell_deg: float = 0.01,
+        snapshot_path: str = "",
+        snapshot_interval: float = 300.0
+    ):
+        self.max_places = max_places
+        self.cell_deg = cell_deg
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.places: "OrderedDict[str, Place]" = OrderedDict()
+        self._cells: Dict[Tuple[int, int], Set[str]] = {}
+        self._rubric_words: Dict[str, Set[str]] = {}
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._changed = False
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+    async def start(self) -> None:
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            try:
+                items = await asyncio.to_thread(self._read_snapshot)
+                self.add(Place(**item) for item in items)
+                self._changed = False
+                logging.info(f"Loaded {len(self.places)} places from index snapshot")
+            except Exception as e:
+                logging.error(f"Error loading place index snapshot: {e}")
+        if self.snapshot_path and self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+
+    async def close(self) -> None:
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            try:
+                await self._snapshot_task
+            except asyncio.CancelledError:
+                pass
+            self._snapshot_task = None
+        await self.snapshot()
+
+    def add(self, places: Iterable[Place]) -> None:
+        for place in places:
+            if not place.id or not place.coordinates.get("lat"):
+                continue
+            if place.id in self.places:
+                self._remove(place.id)
+            self.places[place.id] = place
+            self._cells.setdefault(self._cell(place.coordinates["lat"], place.coordinates["lon"]), set()).add(place.id)
+            for word in self._rubric_tokens(place):
+                self._rubric_words.setdefault(word, set()).add(place.id)
+            self._changed = True
+
+        while len(self.places) > self.max_places:
+            self._remove(next(iter(self.places)))
+
+    def query(
+        self,
+        terms: List[str],
+        location: Dict[str, float],
+        radius: float,
+        limit: int = 10
+    ) -> List[Place]:
+        """Места в радиусе radius метров от точки, рубрики которых совпадают хотя бы
+        с одним из terms (без terms - любые), ближайшие и самые релевантные первыми."""
+        lat, lon = location["lat"], location["lon"]
+        lat_cells = math.ceil(radius / METERS_PER_DEGREE / self.cell_deg)
+        lon_cells = math.ceil(radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)) / self.cell_deg)
+        center_lat, center_lon = self._cell(lat, lon)
+
+        candidates: Set[str] = set()
+        for i in range(center_lat - lat_cells, center_lat + lat_cells + 1):
+            for j in range(center_lon - lon_cells, center_lon + lon_cells + 1):
+                candidates |= self._cells.get((i, j), set())
+
+        stems = [_stem(word) for term in terms for word in term.lower().split() if len(word) > 2]
+        matches: Dict[str, int] = {}
+        if stems:
+            for stem in stems:
+                for word, ids in self._rubric_words.items():
+                    if word.startswith(stem):
+                        for place_id in ids & candidates:
+                            matches[place_id] = matches.get(place_id, 0) + 1
+            candidates = set(matches)
+
+        scored = []
+        for place_id in candidates:
+            place = self.places[place_id]
+            distance = _haversine_m(lat, lon, place.coordinates["lat"], place.coordinates["lon"])
+            if distance <= radius:
+                scored.append((-matches.get(place_id, 0), distance, place))
+        scored.sort(key=lambda item: (item[0], item[1]))
+        return [place for _, _, place in scored[:limit]]
+
+    async def snapshot(self) -> None:
+        if not self.snapshot_path or not self._changed:
+            return
+        items = [asdict(place) for place in self.places.values()]
+        self._changed = False
+        try:
+            await asyncio.to_thread(self._write_snapshot, items)
+        except Exception as e:
+            self._changed = True
+            logging.error(f"Error writing place index snapshot: {e}")
+
+    async def _snapshot_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.snapshot()
+
+    def _read_snapshot(self) -> List[Dict]:
+        with open(self.snapshot_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_snapshot(self, items: List[Dict]) -> None:
+        # Запись во временный файл и атомарная замена, чтобы не оставить битый снимок
+        # pid в имени: процессы-шарды могут писать снимок одновременно
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    @staticmethod
+    def _rubric_tokens(place: Place) -> Set[str]:
+        return {word for rubric in place.categories for word in rubric.lower().split() if len(word) > 2}
+
+    def _remove(self, place_id: str) -> None:
+        place = self.places.pop(place_id)
+        cell = self._cell(place.coordinates["lat"], place.coordinates["lon"])
+        ids = self._cells.get(cell)
+        if ids is not None:
+            ids.discard(place_id)
+            if not ids:
+                del self._cells[cell]
+        for word in self._rubric_tokens(place):
+            ids = self._rubric_words.get(word)
+            if ids is not None:
+                ids.discard(place_id)
+                if not ids:
+                    del self._rubric_words[word]
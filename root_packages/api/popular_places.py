@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .cache import geohash_center, geohash_encode
+from .gis_client import Place
+from .upstream import TokenBucket
+
+
+# fetch(location, radius, limit, sort) - живой запрос популярных мест в 2ГИС
+PopularFetch = Callable[[Dict[str, float], int, int, str], Awaitable[Optional[List[Place]]]]
+
+
+class _Tile:
+    __slots__ = ("location", "places", "refreshed_at", "last_seen")
+
+    def __init__(self, key: str):
+        # Центр тайла: от него ищутся места и при заполнении, и при обновлении,
+        # поэтому список одинаково подходит всем пользователям тайла
+        lat, lon = geohash_center(key)
+        self.location = {"lat": lat, "lon": lon}
+        self.places: Optional[List[Place]] = None
+        self.refreshed_at = 0.0
+        self.last_seen = 0.0
+
+
+class PopularPlaces:
+    """Заранее подготовленные списки популярных мест по тайлам geohash.
+
+    Поиск без критериев (запрос "популярные места") отвечается из памяти.
+    Тайл попадает в кэш при первом таком поиске, который выполняется от центра
+    тайла (center), а не от точки пользователя, и обновляется в фоне раз в
+    refresh_interval, пока за последние tile_ttl секунд в нем были запросы;
+    тайлы без трафика удаляются. Фоновые запросы ограничены бюджетом
+    refresh_per_minute, который расходуется сначала на тайлы без данных, затем
+    на самые устаревшие, поэтому в пики кэш не тратит квоту 2ГИС сверх бюджета.
+    """
+
+    def __init__(
+        self,
+        precision: int = 5,
+        radius: int = 5000,
+        limit: int = 30,
+        sort: str = "rating",
+        refresh_interval: float = 1800.0,
+        tile_ttl: float = 6 * 3600.0,
+        max_tiles: int = 500,
+        refresh_per_minute: float = 6.0
+    ):
+        self.precision = precision
+        self.radius = radius
+        self.limit = limit
+        self.sort = sort
+        self.refresh_interval = refresh_interval
+        self.tile_ttl = tile_ttl
+        self.max_tiles = max_tiles
+        self.refresh_per_minute = refresh_per_minute
+        self.tiles: "OrderedDict[str, _Tile]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._budget = TokenBucket(refresh_per_minute, capacity=1)
+        self._fetch: Optional[PopularFetch] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    async def start(self, fetch: PopularFetch) -> None:
+        self._fetch = fetch
+        if self._task is None and self.refresh_per_minute > 0:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def covers(self, radius: int, limit: int, sort: str) -> bool:
+        """Подходит ли поиск с такими параметрами для ответа из тайлов."""
+        return sort == self.sort and radius <= self.radius and limit <= self.limit
+
+    def center(self, location: Dict[str, float]) -> Dict[str, float]:
+        """Центр тайла, в который попадает точка."""
+        lat, lon = geohash_center(geohash_encode(location["lat"], location["lon"], self.precision))
+        return {"lat": lat, "lon": lon}
+
+    def get(self, location: Dict[str, float], limit: int) -> Optional[List[Place]]:
+        """Места тайла точки или None; любой вызов учитывается как трафик тайла."""
+        tile = self._touch(location)
+        if tile.places is None:
+            self.misses += 1
+            # Тайл заполнит живой поиск вызывающего (put), фоновое обновление не дублирует его
+            tile.refreshed_at = tile.last_seen
+            return None
+        self.hits += 1
+        return tile.places[:limit]
+
+    def put(self, location: Dict[str, float], places: List[Place]) -> None:
+        """Заполняет пустой тайл результатом живого поиска, не дожидаясь фонового обновления."""
+        tile = self._touch(location)
+        if tile.places is None:
+            tile.places = list(places)
+            tile.refreshed_at = time.monotonic()
+
+    def _touch(self, location: Dict[str, float]) -> _Tile:
+        key = geohash_encode(location["lat"], location["lon"], self.precision)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = _Tile(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        else:
+            self.tiles.move_to_end(key)
+        tile.last_seen = time.monotonic()
+        return tile
+
+    def _next_due(self, now: float) -> Optional[_Tile]:
+        # Тайлы упорядочены по последнему запросу: в начале - давно не запрашивавшиеся
+        while self.tiles:
+            key, tile = next(iter(self.tiles.items()))
+            if now - tile.last_seen <= self.tile_ttl:
+                break
+            del self.tiles[key]
+
+        due = None
+        for tile in self.tiles.values():
+            # refreshed_at == 0 - тайл еще ни разу не обновлялся
+            if tile.refreshed_at and now - tile.refreshed_at < self.refresh_interval:
+                continue
+            # Пустые тайлы раньше устаревших, среди устаревших - самые старые
+            if due is None or (tile.places is None, -tile.refreshed_at) > (due.places is None, -due.refreshed_at):
+                due = tile
+        return due
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            tile = self._next_due(time.monotonic())
+            if tile is None:
+                await asyncio.sleep(60 / self.refresh_per_minute)
+                continue
+            await self._budget.acquire()
+            await self._refresh(tile)
+
+    async def _refresh(self, tile: _Tile) -> None:
+        try:
+            places = await self._fetch(tile.location, self.radius, self.limit, self.sort)
+        except Exception as e:
+            logging.error(f"Error refreshing popular places: {e}")
+            places = None
+        # При ошибке тайл откладывается на интервал, старый список продолжает отдаваться
+        tile.refreshed_at = time.monotonic()
+        if places is not None:
+            tile.places = places
+            self.refreshes += 1
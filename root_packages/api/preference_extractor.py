@@ -0,0 +1,115 @@
+import re
+from typing import Dict, List, Optional, Pattern, Tuple
+
+
+# Значения совпадают с перечислениями из промпта analyze_user_response.
+# Шаблоны проверяются на целое слово, поэтому "недорого" не совпадает с "дорог".
+# У категорий, занятий и коротких основ окончания перечислены явно: открытое
+# "вечер\w*" совпало бы с "вечеринку", "кафе\w*" - с "кафедра", "кино\w*" - с "кинолог".
+_RULES: Dict[str, Dict[str, List[str]]] = {
+    "category": {
+        "ресторан": [r"ресторан(а|е|у|ом|ы|ов|ах|ам|ами)?", r"ресторанчик(а|е|и|ом|ов)?"],
+        "кафе": [r"кафе", r"кафешк(а|у|е|и|ой|ах)", r"кофейн(я|ю|е|и|ей|ях|ям)", r"кофе"],
+        "развлечения": [
+            r"кино", r"кинотеатр(а|е|у|ом|ы|ов)?", r"боулинг(а|е|у|ом)?", r"квест(а|е|у|ом|ы|ов)?",
+            r"караоке", r"аттракцион(а|е|у|ом|ы|ов|ах)?"
+        ],
+        "спорт": [
+            r"спортзал(а|е|у|ом|ы)?", r"фитнес(а|е|у|ом)?", r"бассейн(а|е|у|ом|ы)?", r"тренаж[её]рк(а|у|е|и|ой)",
+            r"спорт(а|е|у|ом)?", r"спортивн(ый|ое|ая|ые|ом|ую|ого|ых)"
+        ],
+        "культура": [
+            r"музе(й|я|е|ю|ем|и|ев|ях)", r"театр(а|е|у|ом|ы|ов)?", r"выставк(а|у|е|и|ой)", r"выставок",
+            r"галере(я|ю|е|и|ей|ях)", r"концерт(а|е|у|ом|ы|ов)?"
+        ],
+        "шоппинг": [r"магазин(а|е|у|ом|ы|ов|ах|ам)?", r"шо(п|пп)инг(а|е|у|ом)?", r"тц"],
+        # Одно "салон" бывает и автосалоном: красоту распознаем по "салон красоты" через "красоты"
+        "красота": [
+            r"маникюр(а|е|у|ом)?", r"парикмахерск(ая|ую|ой|ие|их)", r"барбершоп(а|е|у|ом)?", r"спа",
+            r"красот(а|у|ы|е|ой)"
+        ],
+        "услуги": [r"услуг(а|у|и|е|ой|ам|ами|ах)?", r"ремонт(а|е|у|ом|ы|ов)?", r"химчистк(а|у|е|и|ой)"],
+    },
+    "price_range": {
+        "бюджетно": [r"недорог(о|ой|ое|ая|ие|ую|ого|их|ом)", r"дешев\w*", r"дешёв\w*", r"бюджетн\w*", r"эконом\w*"],
+        "средний": [r"средн\w*"],
+        "премиум": [r"дорог(о|ой|ое|ая|ие|ую|ого|их|ом)", r"дороже", r"дороговат\w*", r"дорогущ\w*", r"премиум\w*", r"элитн\w*", r"люкс\w*", r"пафосн\w*"],
+    },
+    "activity_type": {
+        "еда": [r"поесть", r"покушать", r"поужинать", r"пообедать", r"позавтракать", r"перекусить", r"еда", r"еду", r"еды"],
+        "развлечения": [r"развлечени(е|я|й|ю|ем|ям|ях|ями)", r"развлечься", r"повеселиться", r"потусить", r"тусовк(а|у|е|и|ой)"],
+        "отдых": [r"отдохнуть", r"отдых(а|е|у|ом)?", r"расслабиться", r"погулять", r"прогулк(а|у|е|и|ой)"],
+    },
+    "time_preference": {
+        "утром": [r"утр(о|ом|а|енн(ий|ее|яя|ие|ем|юю|его|ей))"],
+        "днем": [r"дн[её]м", r"дневн(ой|ое|ая|ые|ом|ую|ого)"],
+        "вечером": [r"вечер(ом|а|ний|нее|няя|ние|нем|нюю|него|ней)?"],
+        "ночью": [r"ноч(ью|ь|и|ной|ное|ная|ные|ную|ного)"],
+        "выходные": [r"выходн\w*", r"суббот\w*", r"воскресень\w*"],
+        "будни": [r"будн\w*", r"понедельник\w*", r"вторник\w*", r"сред[уы]", r"четверг\w*", r"пятниц\w*"],
+    },
+}
+
+# Слова, которые не несут предпочтений и не делают ответ неоднозначным
+_STOPWORDS = frozenset("""
+    а в во и или на по за к ко с со у о об от до для из же ли бы то
+    я мне меня мы нам нас ты тебе хочу хочется хотим хотелось хотел хотела
+    где куда какое какой какую какие что нибудь либо можно давай давайте лучше
+    сходить пойти поехать сходим пойдем пойдём место места местечко
+    да ну вот просто очень тоже еще ещё было бы пожалуйста наверное
+    сегодня завтра
+""".split())
+
+# Отрицания и сравнения меняют смысл найденных слов: такие ответы разбирает LLM
+_AMBIGUOUS = frozenset(["не", "нет", "без", "кроме", "только", "но"])
+
+_WORD_RE = re.compile(r"[а-яёa-z0-9]+")
+
+
+class PreferenceExtractor:
+    """Локальный разбор простых ответов пользователя без обращения к LLM.
+
+    extract возвращает словарь в формате ответа analyze_user_response, если
+    каждое значимое слово распознано однозначно, и None в остальных случаях.
+    """
+
+    def __init__(self, rules: Dict[str, Dict[str, List[str]]] = _RULES):
+        self._matchers: List[Tuple[str, str, Pattern]] = [
+            (field_name, value, re.compile("|".join(patterns)))
+            for field_name, values in rules.items()
+            for value, patterns in values.items()
+        ]
+
+    def extract(self, text: str) -> Optional[Dict]:
+        words = _WORD_RE.findall(text.lower())
+        if not words or len(words) > 8:
+            return None
+
+        result: Dict = {}
+        for word in words:
+            if word in _AMBIGUOUS:
+                return None
+            if word in _STOPWORDS:
+                continue
+
+            match = self._match_word(word)
+            if match is None:
+                return None
+
+            field_name, value = match
+            if result.get(field_name, value) != value:
+                # Противоречивые значения одного поля - пусть разбирается LLM
+                return None
+            result[field_name] = value
+
+        if not result:
+            return None
+        result["specific_requirements"] = []
+        return result
+
+    def _match_word(self, word: str) -> Optional[Tuple[str, str]]:
+        for field_name, value, pattern in self._matchers:
+            if pattern.fullmatch(word):
+                return field_name, value
+        return None
+
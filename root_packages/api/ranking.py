@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .gis_client import Place
+from .openai_client import UserPreferences
+
+
+EARTH_RADIUS_KM = 6371.0
+
+
+@dataclass
+class RankingWeights:
+    rating: float = 1.0
+    reviews: float = 0.5
+    distance: float = 1.0
+    relevance: float = 1.5
+    # Расстояние, на котором вклад близости падает вдвое
+    distance_scale_km: float = 1.5
+
+
+def _requirement_stems(preferences: UserPreferences) -> List[str]:
+    words = []
+    for text in [preferences.category, preferences.activity_type, *(preferences.specific_requirements or [])]:
+        if text:
+            words.extend(text.lower().split())
+    # Грубая основа слова, чтобы "кофейня" совпадала с "кофейни"
+    return list({word[:max(4, len(word) - 2)] for word in words if len(word) > 2})
+
+
+def rank_places(
+    places: List[Place],
+    location: Optional[Dict[str, float]],
+    preferences: UserPreferences,
+    weights: RankingWeights = RankingWeights()
+) -> List[Place]:
+    """Переупорядочивает кандидатов по взвешенной оценке, посчитанной одним пакетом.
+
+    Оценка складывается из рейтинга, логарифма числа отзывов, близости к
+    пользователю (haversine) и доли требований, найденных в рубриках места.
+    """
+    count = len(places)
+    if count < 2:
+        return list(places)
+
+    rating = np.fromiter((place.rating or 0.0 for place in places), dtype=np.float64, count=count) / 5.0
+
+    reviews = np.log1p(np.fromiter((place.reviews_count or 0 for place in places), dtype=np.float64, count=count))
+    reviews_max = reviews.max()
+    if reviews_max > 0:
+        reviews /= reviews_max
+
+    score = weights.rating * rating + weights.reviews * reviews
+
+    if location and weights.distance:
+        lat = np.radians(np.fromiter((place.coordinates.get("lat", 0.0) for place in places), dtype=np.float64, count=count))
+        lon = np.radians(np.fromiter((place.coordinates.get("lon", 0.0) for place in places), dtype=np.float64, count=count))
+        user_lat = np.radians(location["lat"])
+        user_lon = np.radians(location["lon"])
+        a = np.sin((lat - user_lat) / 2) ** 2 + np.cos(user_lat) * np.cos(lat) * np.sin((lon - user_lon) / 2) ** 2
+        distance_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+        score += weights.distance * weights.distance_scale_km / (weights.distance_scale_km + distance_km)
+
+    stems = _requirement_stems(preferences)
+    if stems and weights.relevance:
+        rubrics = [" ".join(place.categories).lower() for place in places]
+        matches = np.fromiter(
+            (sum(stem in text for stem in stems) for text in rubrics),
+            dtype=np.float64,
+            count=count
+        )
+        score += weights.relevance * matches / len(stems)
+
+    # Устойчивая сортировка сохраняет порядок 2ГИС при равной оценке
+    order = np.argsort(-score, kind="stable")
+    return [places[i] for i in order]
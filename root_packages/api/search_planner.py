@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from .gis_client import CATEGORY_MAPPING, GISClient, Place
+from .openai_client import UserPreferences
+
+
+class SearchPlanner:
+    """Параллельный поиск по нескольким вариантам запроса.
+
+    Строгий запрос со всеми критериями часто ничего не находит, поэтому вместе
+    с ним выполняются ослабленные варианты: без особых требований, по каждому
+    требованию отдельно и только по категории. Результаты объединяются по
+    Place.id в порядке приоритета вариантов. Одновременно выполняется не больше
+    max_parallel запросов, всего - не больше max_variants; как только
+    завершившиеся подряд по приоритету варианты дали достаточно мест,
+    оставшиеся запросы отменяются, а незапущенные не отправляются.
+    """
+
+    def __init__(
+        self,
+        gis_client: GISClient,
+        max_parallel: int = 3,
+        enough_results: int = 5,
+        max_variants: int = 3
+    ):
+        self.gis_client = gis_client
+        self.max_parallel = max_parallel
+        self.enough_results = enough_results
+        self.max_variants = max_variants
+
+    def build_queries(self, preferences: UserPreferences) -> List[Optional[str]]:
+        category = CATEGORY_MAPPING.get(preferences.category) if preferences.category else None
+        activity = preferences.activity_type if preferences.activity_type != preferences.category else None
+        requirements = preferences.specific_requirements or []
+
+        variants = [
+            [category, activity, *requirements],
+            [category, activity],
+            *([category or activity, requirement] for requirement in requirements),
+            [category],
+            [activity],
+        ]
+
+        queries: List[Optional[str]] = []
+        for terms in variants:
+            query = " ".join(term for term in terms if term)
+            if query and query not in queries:
+                queries.append(query)
+
+        # Без критериев остается запрос по умолчанию ("популярные места")
+        return queries[:self.max_variants] or [None]
+
+    async def search(
+        self,
+        preferences: UserPreferences,
+        location: Optional[Dict[str, float]] = None,
+        radius: int = 2000,
+        limit: int = 10,
+        sort: str = 'rating',
+        page: int = 1
+    ) -> List[Place]:
+        queries = self.build_queries(preferences)
+
+        def launch(index: int) -> asyncio.Task:
+            return asyncio.create_task(self.gis_client.search_places(
+                preferences, location, radius=radius, limit=limit, sort=sort, query=queries[index], page=page
+            ))
+
+        # Следующий вариант запускается, только когда освободился слот и
+        # приоритетных результатов все еще мало
+        results: List[Optional[List[Place]]] = [None] * len(queries)
+        finished = [False] * len(queries)
+        running: Dict[asyncio.Task, int] = {}
+        launched = 0
+        try:
+            while launched < len(queries) or running:
+                while launched < len(queries) and len(running) < self.max_parallel:
+                    running[launch(launched)] = launched
+                    launched += 1
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index = running.pop(task)
+                    finished[index] = True
+                    if task.exception() is not None:
+                        logging.warning(f"Search variant failed: {task.exception()}")
+                        continue
+                    results[index] = task.result()
+                if self._count_finished_prefix(results, finished) >= self.enough_results:
+                    break
+        finally:
+            for task in running:
+                task.cancel()
+
+        return self._merge(results)[:limit]
+
+    @staticmethod
+    def _count_finished_prefix(results: List[Optional[List[Place]]], finished: List[bool]) -> int:
+        # Считаются только варианты до первого незавершенного: быстрый ослабленный
+        # запрос не должен вытеснять более строгий, который еще выполняется
+        seen = set()
+        for places, is_finished in zip(results, finished):
+            if not is_finished:
+                break
+            seen.update(place.id for place in places or ())
+        return len(seen)
+
+    @staticmethod
+    def _merge(results: List[Optional[List[Place]]]) -> List[Place]:
+        merged: Dict[str, Place] = {}
+        for places in results:
+            for place in places or ():
+                merged.setdefault(place.id, place)
+        return list(merged.values())
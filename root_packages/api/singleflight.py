@@ -0,0 +1,23 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые вызовы: выполняется только первый,
+    остальные ожидают и получают тот же результат (или то же исключение)."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            # Общий вызов живет в отдельной задаче, поэтому отмена любого
+            # из ожидающих (включая первого) не прерывает его для остальных
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
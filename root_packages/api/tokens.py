@@ -0,0 +1,33 @@
+import re
+from typing import Dict, Iterable
+
+
+_PIECE_RE = re.compile(r"[а-яё]+|[a-z]+|\d+|[^\sа-яёa-z\d]", re.IGNORECASE)
+_CYRILLIC_RE = re.compile(r"[а-яё]", re.IGNORECASE)
+
+# Служебные токены, которые модель добавляет к каждому сообщению чата
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов без токенизатора модели.
+
+    Русские слова в BPE-словарях GPT делятся примерно на куски по 3 символа,
+    английские - по 4, числа - по 3 цифры, знаки препинания идут отдельными токенами.
+    Оценка намеренно чуть завышена, чтобы бюджет не превышался.
+    """
+    tokens = 0
+    for piece in _PIECE_RE.findall(text):
+        if len(piece) == 1:
+            tokens += 1
+        elif _CYRILLIC_RE.match(piece):
+            tokens += (len(piece) + 2) // 3
+        elif piece.isdigit():
+            tokens += (len(piece) + 2) // 3
+        else:
+            tokens += (len(piece) + 3) // 4
+    return tokens
+
+
+def estimate_messages_tokens(messages: Iterable[Dict]) -> int:
+    return sum(estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
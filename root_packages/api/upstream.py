@@ -0,0 +1,373 @@
+import math
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Optional, Tuple
+
+import aiohttp
+
+from root_packages.metrics import (
+    UPSTREAM_CIRCUIT_OPEN,
+    UPSTREAM_HEDGED,
+    UPSTREAM_REJECTED,
+    UPSTREAM_SECONDS,
+    UPSTREAM_WAIT_SECONDS,
+    error_status
+)
+
+
+class UpstreamError(Exception):
+    """Ответ внешнего API с неуспешным статусом."""
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"upstream responded with status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """Внешний API считается недоступным: вызов отклонен без запроса."""
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} circuit is open")
+        self.name = name
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+def default_classify(error: BaseException) -> Tuple[bool, Optional[float]]:
+    """Возвращает (можно ли повторить запрос, Retry-After в секундах)."""
+    if isinstance(error, UpstreamError):
+        return error.status == 429 or error.status >= 500, error.retry_after
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, ConnectionError)):
+        return True, None
+    return False, None
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60
+        # По умолчанию допускаем всплеск объемом в 10 секунд квоты
+        self.capacity = capacity or max(rate_per_minute / 6, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """Берет токены, только если они доступны сразу."""
+        if self._lock.locked():
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.capacity)
+        # Блокировка сохраняет очередность ожидающих
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD-ограничитель параллельных запросов: лимит плавно растет на успешных
+    ответах и уменьшается вдвое при перегрузке (429/5xx/таймауты)."""
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease_cooldown: float = 1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_cooldown = decrease_cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    async def release(self, overloaded: bool = False) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                # Одна волна ошибок уменьшает лимит один раз, а не на каждый ответ
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Размыкатель по доле неудачных вызовов в скользящем окне.
+
+    Неудачей считаются перегрузка и таймауты (повторяемые ошибки), а также
+    успешные ответы медленнее slow_call_duration. Когда среди последних window
+    вызовов (не меньше min_calls) доля неудач достигает failure_ratio, breaker
+    открывается на open_duration секунд, затем пропускает один пробный вызов:
+    breaker закрывает только его успешный ответ, любое исключение (включая
+    неповторяемые ошибки) снова открывает.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_ratio: float = 0.5,
+        slow_call_duration: float = 0.0,
+        window: int = 20,
+        min_calls: int = 10,
+        open_duration: float = 30.0
+    ):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.slow_call_duration = slow_call_duration
+        self.min_calls = min_calls
+        self.open_duration = open_duration
+        self.state = self.CLOSED
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._failures = 0
+        self._changed_at = 0.0
+        self._probe = 0
+
+    def allow(self) -> Optional[int]:
+        """None - вызов отклонен; 0 - обычный вызов; иначе номер пробного вызова,
+        который нужно передать в record вместе с его результатом."""
+        if self.state == self.CLOSED:
+            return 0
+        now = time.monotonic()
+        # Пробный вызов пропускается раз в open_duration, даже если предыдущий потерялся при отмене
+        if now - self._changed_at < self.open_duration:
+            return None
+        self._set_state(self.HALF_OPEN, now)
+        self._probe += 1
+        return self._probe
+
+    def record(self, failure: bool, duration: float = 0.0, error: bool = False, probe: int = 0) -> None:
+        """failure - перегрузка или таймаут; error - вызов завершился любым исключением.
+
+        Пока breaker не закрыт, учитывается только результат текущего пробного
+        вызова: запоздавшие ответы запросов, начатых до открытия, игнорируются.
+        """
+        if not failure and self.slow_call_duration and duration > self.slow_call_duration:
+            failure = True
+
+        if self.state != self.CLOSED:
+            if self.state != self.HALF_OPEN or probe != self._probe:
+                return
+            if failure or error:
+                self._set_state(self.OPEN, time.monotonic())
+            else:
+                self._outcomes.clear()
+                self._failures = 0
+                self._set_state(self.CLOSED, time.monotonic())
+            return
+        if probe:
+            return
+
+        if len(self._outcomes) == self._outcomes.maxlen and self._outcomes[0]:
+            self._failures -= 1
+        self._outcomes.append(failure)
+        self._failures += failure
+        if len(self._outcomes) >= self.min_calls and self._failures / len(self._outcomes) >= self.failure_ratio:
+            logging.error(f"{self.name} circuit opened: {self._failures}/{len(self._outcomes)} calls failed")
+            self._set_state(self.OPEN, time.monotonic())
+
+    def _set_state(self, state: str, now: float) -> None:
+        self.state = state
+        self._changed_at = now
+        UPSTREAM_CIRCUIT_OPEN.set(self.name, value=float(state != self.CLOSED))
+
+
+class Upstream:
+    """Клиентские ограничения для одного внешнего API: квоты запросов и токенов
+    в минуту, адаптивный параллелизм и повторы с экспоненциальной задержкой.
+
+    timeout ограничивает одну попытку, deadline - весь вызов вместе с ожиданием
+    квоты и повторами (0 - без ограничения). С breaker вызовы при открытом
+    размыкателе сразу завершаются CircuitOpenError. С hedge медленная попытка
+    дублируется через p95 недавних задержек (не раньше hedge_min_delay), если
+    для второго запроса сразу есть квота запросов и токенов и слот; берется
+    первый успешный ответ.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        max_concurrency: int = 32,
+        min_concurrency: int = 1,
+        classify: Callable[[BaseException], Tuple[bool, Optional[float]]] = default_classify,
+        timeout: float = 0.0,
+        deadline: float = 0.0,
+        breaker: Optional[CircuitBreaker] = None,
+        hedge: bool = False,
+        hedge_min_delay: float = 0.1
+    ):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrencyLimiter(max_concurrency, min_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.classify = classify
+        self.timeout = timeout
+        self.deadline = deadline
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self._latencies: Deque[float] = deque(maxlen=200)
+        self._latency_samples = 0
+        self._hedge_delay: Optional[float] = None
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], tokens: float = 0, hedge: bool = True) -> Any:
+        """hedge=False отключает дублирование для неидемпотентных и потоковых вызовов."""
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + self.deadline if self.deadline else None
+        attempt = 0
+        while True:
+            probe = 0
+            if self.breaker is not None:
+                probe = self.breaker.allow()
+                if probe is None:
+                    UPSTREAM_REJECTED.inc(self.name)
+                    raise CircuitOpenError(self.name)
+
+            waiting_since = time.perf_counter()
+            acquire = self._acquire(tokens)
+            if deadline_at is None:
+                await acquire
+            else:
+                await asyncio.wait_for(acquire, timeout=max(deadline_at - loop.time(), 0.0))
+            started = time.perf_counter()
+            UPSTREAM_WAIT_SECONDS.observe(started - waiting_since, self.name)
+
+            timeout = self.timeout or None
+            if deadline_at is not None:
+                timeout = min(timeout or math.inf, max(deadline_at - loop.time(), 0.0))
+            try:
+                result = await self._attempt(fn, timeout, hedge and self.hedge, tokens)
+            except Exception as e:
+                duration = time.perf_counter() - started
+                UPSTREAM_SECONDS.observe(duration, self.name, error_status(e))
+                retryable, retry_after = self.classify(e)
+                if self.breaker is not None:
+                    self.breaker.record(retryable, duration, error=True, probe=probe)
+                await self.concurrency.release(overloaded=retryable)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+                if deadline_at is not None and loop.time() + delay >= deadline_at:
+                    raise
+                attempt += 1
+                logging.warning(f"{self.name} request failed ({e}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name, "cancelled")
+                await self.concurrency.release()
+                raise
+
+            duration = time.perf_counter() - started
+            UPSTREAM_SECONDS.observe(duration, self.name, "ok")
+            if self.breaker is not None:
+                self.breaker.record(False, duration, probe=probe)
+            self._record_latency(duration)
+            await self.concurrency.release()
+            return result
+
+    async def _acquire(self, tokens: float) -> None:
+        if self.requests is not None:
+            await self.requests.acquire()
+        if self.tokens is not None and tokens:
+            await self.tokens.acquire(tokens)
+        await self.concurrency.acquire()
+
+    async def _attempt(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        timeout: Optional[float],
+        hedge: bool,
+        tokens: float = 0
+    ) -> Any:
+        if not hedge or self._hedge_delay is None or (timeout is not None and timeout <= self._hedge_delay):
+            return await asyncio.wait_for(fn(), timeout)
+
+        primary = asyncio.ensure_future(asyncio.wait_for(fn(), timeout))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay)
+            if done or not self._try_acquire_hedge(tokens):
+                return await primary
+
+            remaining = None if timeout is None else timeout - self._hedge_delay
+            hedged = asyncio.ensure_future(asyncio.wait_for(fn(), remaining))
+            # Слот освобождается колбэком: задачу могут отменить до ее первого шага
+            hedged.add_done_callback(lambda _: asyncio.ensure_future(self.concurrency.release()))
+            tasks.add(hedged)
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    UPSTREAM_HEDGED.inc(self.name, "primary" if succeeded[0] is primary else "hedge")
+                    return succeeded[0].result()
+            # Обе попытки неудачны: наружу уходит ошибка основной
+            return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _try_acquire_hedge(self, tokens: float = 0) -> bool:
+        # Дублирующий запрос не ждет квоту: если ее нет сразу, ждем основной ответ.
+        # Он тратит столько же токенов, сколько основной, и списывает их из той же квоты
+        if self.tokens is not None and tokens and not self.tokens.try_acquire(tokens):
+            return False
+        if self.requests is not None and not self.requests.try_acquire():
+            return False
+        return self.concurrency.try_acquire()
+
+    def _record_latency(self, duration: float) -> None:
+        self._latencies.append(duration)
+        self._latency_samples += 1
+        # p95 пересчитывается раз в 20 успешных ответов, а не на каждый вызов
+        if self.hedge and self._latency_samples % 20 == 0:
+            ordered = sorted(self._latencies)
+            self._hedge_delay = max(self.hedge_min_delay, ordered[int(len(ordered) * 0.95) - 1])
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: случайная задержка до экспоненциальной границы
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
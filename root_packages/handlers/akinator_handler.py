@@ -1,18 +1,147 @@
 from aiogram import types, Router
 from aiogram.dispatcher.dispatcher import Dispatcher
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import asyncio
 import logging
+from typing import Optional
 
-from root_packages.api import OpenAIClient, GISClient
+from root_packages.api import OpenAIClient, GISClient, UserPreferences
+from root_packages.api.openai_client import classify_openai_error
+from root_packages.api.place_index import PlaceIndex
+from root_packages.api.popular_places import PopularPlaces
+from root_packages.api.preference_extractor import PreferenceExtractor
+from root_packages.api.ranking import RankingWeights, rank_places
+from root_packages.api.search_planner import SearchPlanner
+from root_packages.api.upstream import CircuitBreaker, Upstream
+from root_packages.handlers.streaming import answer_streamed
+from root_packages.metrics import Counter, Gauge
+from root_packages.middleware import HandlerMetricsMiddleware, SessionLoadMiddleware, UserQueueMiddleware
+from root_packages.root import outbound_queue
 from root_packages.state import state_manager
 from settings import settings
 
 
 dp = Dispatcher()
+user_queue = UserQueueMiddleware(
+    max_in_flight=settings.concurrency.max_in_flight,
+    max_user_queue=settings.concurrency.max_user_queue,
+    max_waiting=settings.concurrency.max_waiting
+)
+dp.update.outer_middleware(user_queue)
+dp.update.outer_middleware(SessionLoadMiddleware(state_manager))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
 router = Router()
-openai_client = OpenAIClient(api_key=settings.openai.api_key, model=settings.openai.model)
-gis_client = GISClient(settings.gis.api_key)
+openai_client = OpenAIClient(
+    api_key=settings.openai.api_key,
+    model=settings.openai.model,
+    upstream=Upstream(
+        "openai",
+        requests_per_minute=settings.openai.requests_per_minute,
+        tokens_per_minute=settings.openai.tokens_per_minute,
+        max_retries=settings.openai.max_retries,
+        backoff_base=settings.openai.backoff_base,
+        backoff_max=settings.openai.backoff_max,
+        max_concurrency=settings.openai.max_concurrency,
+        min_concurrency=settings.openai.min_concurrency,
+        classify=classify_openai_error,
+        timeout=settings.openai.timeout,
+        deadline=settings.openai.deadline,
+        breaker=CircuitBreaker(
+            "openai",
+            failure_ratio=settings.openai.breaker_failure_ratio,
+            slow_call_duration=settings.openai.breaker_slow_call,
+            open_duration=settings.openai.breaker_open_duration
+        ),
+        hedge=settings.openai.hedge,
+        hedge_min_delay=settings.openai.hedge_min_delay
+    ),
+    extractor=PreferenceExtractor() if settings.openai.local_extractor else None,
+    summary_model=settings.openai.summary_model,
+    timeout=settings.openai.timeout or None
+)
+place_index = PlaceIndex(
+    max_places=settings.gis.index_max_places,
+    cell_deg=settings.gis.index_cell_deg,
+    snapshot_path=settings.gis.index_snapshot_path,
+    snapshot_interval=settings.gis.index_snapshot_interval
+)
+# Радиус, размер и сортировка совпадают с поиском в search_places_for
+popular_places = PopularPlaces(
+    precision=settings.gis.popular_precision,
+    radius=5000,
+    limit=settings.ranking.candidate_pool,
+    refresh_interval=settings.gis.popular_refresh_interval,
+    tile_ttl=settings.gis.popular_tile_ttl,
+    max_tiles=settings.gis.popular_max_tiles,
+    refresh_per_minute=settings.gis.popular_refresh_per_minute
+)
+gis_client = GISClient(
+    settings.gis.api_key,
+    connection_limit=settings.gis.connection_limit,
+    connection_limit_per_host=settings.gis.connection_limit_per_host,
+    keepalive_timeout=settings.gis.keepalive_timeout,
+    dns_cache_ttl=settings.gis.dns_cache_ttl,
+    cache_ttl=settings.gis.cache_ttl,
+    cache_max_entries=settings.gis.cache_max_entries,
+    cache_max_bytes=settings.gis.cache_max_bytes,
+    cache_geohash_precision=settings.gis.cache_geohash_precision,
+    upstream=Upstream(
+        "2gis",
+        requests_per_minute=settings.gis.requests_per_minute,
+        max_retries=settings.gis.max_retries,
+        backoff_base=settings.gis.backoff_base,
+        backoff_max=settings.gis.backoff_max,
+        max_concurrency=settings.gis.max_concurrency,
+        min_concurrency=settings.gis.min_concurrency,
+        timeout=settings.gis.timeout,
+        deadline=settings.gis.deadline,
+        breaker=CircuitBreaker(
+            "2gis",
+            failure_ratio=settings.gis.breaker_failure_ratio,
+            slow_call_duration=settings.gis.breaker_slow_call,
+            open_duration=settings.gis.breaker_open_duration
+        ),
+        hedge=settings.gis.hedge,
+        hedge_min_delay=settings.gis.hedge_min_delay
+    ),
+    place_index=place_index,
+    serve_from_index=settings.gis.index_serve_covered,
+    popular_places=popular_places if settings.gis.popular_enabled else None
+)
+search_planner = SearchPlanner(
+    gis_client,
+    max_parallel=settings.gis.planner_max_parallel,
+    enough_results=settings.gis.planner_enough_results,
+    max_variants=settings.gis.planner_max_variants
+)
+ranking_weights = RankingWeights(
+    rating=settings.ranking.rating_weight,
+    reviews=settings.ranking.reviews_weight,
+    distance=settings.ranking.distance_weight,
+    relevance=settings.ranking.relevance_weight,
+    distance_scale_km=settings.ranking.distance_scale_km
+)
+RESULTS_PAGE_SIZE = 3
+
+# Значения читаются из объектов в момент сбора метрик
+Gauge("bot_active_sessions", "Сессии пользователей в памяти", fn=lambda: len(state_manager.sessions))
+Gauge("bot_waiting_updates", "Обновления, ожидающие обработки", fn=lambda: user_queue.waiting)
+Gauge("telegram_outbound_queued", "Запросы в очереди исходящих к Telegram", fn=lambda: outbound_queue.queued)
+Counter("gis_cache_hits_total", "Попадания в кэш ответов 2ГИС", fn=lambda: gis_client.cache.hits)
+Counter("gis_cache_misses_total", "Промахи кэша ответов 2ГИС", fn=lambda: gis_client.cache.misses)
+Gauge(
+    "gis_cache_hit_ratio",
+    "Доля попаданий в кэш ответов 2ГИС",
+    fn=lambda: gis_client.cache.hits / max(1, gis_client.cache.hits + gis_client.cache.misses)
+)
+Gauge("gis_cache_entries", "Записи в кэше ответов 2ГИС", fn=lambda: len(gis_client.cache))
+Gauge("place_index_places", "Места в локальном индексе", fn=lambda: len(place_index))
+Gauge("popular_places_tiles", "Тайлы с трафиком в кэше популярных мест", fn=lambda: len(popular_places))
+Counter("popular_places_hits_total", "Поиски без критериев, отвеченные из тайлов", fn=lambda: popular_places.hits)
+Counter("popular_places_refreshes_total", "Фоновые обновления тайлов популярных мест", fn=lambda: popular_places.refreshes)
 
 
 @dp.message(Command("start"))
@@ -60,17 +189,49 @@ async def handle_location(message: types.Message):
 
 
 
-async def ask_first_question(message: types.Message, user_id: int):
+async def compact_history(user_id: int) -> None:
+    """Сворачивает старые реплики в краткое содержание, если история превысила бюджет."""
+    overflow = state_manager.take_overflow(user_id)
+    if not overflow:
+        return
+    
     session = state_manager.get_or_create_session(user_id)
+    summary = await openai_client.summarize_history(
+        state_manager.get_summary(user_id),
+        overflow,
+        session.preferences
+    )
+    state_manager.set_summary(user_id, summary)
+
+
+async def send_question(message: types.Message, user_id: int, edit: bool = False) -> str:
+    """Генерирует следующий вопрос и показывает его пользователю (потоково, если включено)."""
+    await compact_history(user_id)
+    session = state_manager.get_or_create_session(user_id)
+    history = state_manager.get_conversation_history(user_id)
     
-    try:
-        question = await openai_client.generate_question(
-            session.preferences,
-            state_manager.get_conversation_history(user_id, limit=10)
+    if settings.openai.stream_questions:
+        question = await answer_streamed(
+            message,
+            openai_client.stream_question(session.preferences, history),
+            edit=edit,
+            edit_interval=settings.bot.stream_edit_interval,
+            first_chunk_chars=settings.bot.stream_first_chunk_chars
         )
-        
-        state_manager.add_message(user_id, "assistant", question)
-        await message.answer(question)
+    else:
+        question = await openai_client.generate_question(session.preferences, history)
+        if edit:
+            await message.edit_text(question)
+        else:
+            await message.answer(question)
+    
+    state_manager.add_message(user_id, "assistant", question)
+    return question
+
+
+async def ask_first_question(message: types.Message, user_id: int):
+    try:
+        await send_question(message, user_id)
         
     except Exception as e:
         logging.error(f"Error generating first question: {e}")
@@ -90,13 +251,23 @@ async def handle_user_response(message: types.Message):
     
     # Добавляем сообщение пользователя в историю
     state_manager.add_message(user_id, "user", user_text)
+    await compact_history(user_id)
     
     try:
-        # Анализируем ответ пользователя и обновляем предпочтения
-        updated_preferences = await openai_client.analyze_user_response(
-            user_text, 
-            session.preferences
-        )
+        question = None
+        if settings.openai.combined_turn:
+            # Предпочтения и следующий вопрос приходят одним ответом модели
+            updated_preferences, question = await openai_client.analyze_and_ask(
+                user_text,
+                session.preferences,
+                state_manager.get_conversation_history(user_id)
+            )
+        else:
+            # Анализируем ответ пользователя и обновляем предпочтения
+            updated_preferences = await openai_client.analyze_user_response(
+                user_text, 
+                session.preferences
+            )
         state_manager.update_preferences(user_id, updated_preferences)
         
         # Проверяем, достаточно ли информации для поиска
@@ -113,43 +284,80 @@ async def handle_user_response(message: types.Message):
                 "У меня достаточно информации! Хочешь начать поиск или предпочитаешь ответить на еще несколько вопросов?",
                 reply_markup=keyboard
             )
+            # Пока пользователь читает, поиск уже выполняется в фоне (если есть свободный слот)
+            prefetch = await user_queue.spawn(search_places_for(updated_preferences, session.current_location))
+            if prefetch is not None:
+                state_manager.set_prefetch(user_id, prefetch)
         else:
             # Задаем следующий вопрос
-            question = await openai_client.generate_question(
-                updated_preferences,
-                state_manager.get_conversation_history(user_id, limit=10)
-            )
-            
-            state_manager.add_message(user_id, "assistant", question)
-            await message.answer(question)
+            if question is None:
+                await send_question(message, user_id)
+            else:
+                state_manager.add_message(user_id, "assistant", question)
+                await message.answer(question)
             
     except Exception as e:
         logging.error(f"Error handling user response: {e}")
         await message.answer("Извини, произошла ошибка. Можешь повторить?")
 
 
+async def search_places_for(preferences, location):
+    # Берем расширенный пул кандидатов и упорядочиваем его локально
+    places = await search_planner.search(
+        preferences,
+        location,
+        radius=5000,
+        limit=settings.ranking.candidate_pool
+    )
+    return rank_places(places, location, preferences, ranking_weights)
+
+
 @dp.callback_query(lambda c: c.data == "start_search")
 async def start_search(callback: types.CallbackQuery):
     user_id = callback.from_user.id
+    
+    # UserQueueMiddleware обрабатывает обновления пользователя по очереди, поэтому
+    # повторное нажатие приходит уже после первого поиска и видно по состоянию сессии
+    if state_manager.get_session_state(user_id) == "searching":
+        await callback.answer("🔍 Поиск уже выполнен, результаты выше")
+        return
+    
+    await callback.answer()
+    await run_search(callback, user_id)
+
+
+async def run_search(callback: types.CallbackQuery, user_id: int):
     session = state_manager.get_or_create_session(user_id)
     
     state_manager.set_session_state(user_id, "searching")
     
-    await callback.message.edit_text("🔍 Ищу подходящие места...")
-    await callback.answer()
+    try:
+        await callback.message.edit_text("🔍 Ищу подходящие места...")
+    except TelegramBadRequest as e:
+        # "message is not modified" и т.п. не должны прерывать сам поиск
+        logging.debug(f"Skipping search status edit: {e}")
     
     try:
-        # Выполняем поиск
-        places = await gis_client.search_places(
-            session.preferences,
-            session.current_location,
-            radius=5000,
-            limit=5
-        )
+        # Используем результат фонового поиска, если предпочтения с тех пор не менялись
+        places = None
+        prefetch = state_manager.pop_prefetch(user_id)
+        if prefetch is not None and not prefetch.cancelled():
+            try:
+                places = await prefetch
+            except Exception as e:
+                logging.warning(f"Prefetched search failed, searching again: {e}")
+        
+        if places is None:
+            # Выполняем поиск
+            places = await search_places_for(session.preferences, session.current_location)
         
         if places:
-            state_manager.update_search_results(user_id, places)
-            await show_search_results(callback.message, places, user_id)
+            state_manager.update_search_results(
+                user_id,
+                places,
+                has_more_pages=len(places) >= settings.ranking.candidate_pool
+            )
+            await show_search_results(callback.message, session.last_search_results, user_id)
         else:
             await callback.message.answer(
                 "😔 К сожалению, не удалось найти подходящие места. Попробуй изменить критерии поиска."
@@ -158,44 +366,147 @@ async def start_search(callback: types.CallbackQuery):
             
     except Exception as e:
         logging.error(f"Error during search: {e}")
+        # Возвращаем состояние, иначе повторное нажатие "Искать места" будет отклонено
+        state_manager.set_session_state(user_id, "collecting_preferences")
         await callback.message.answer("Произошла ошибка при поиске. Попробуй еще раз.")
 
 
 @dp.callback_query(lambda c: c.data == "more_questions")
 async def more_questions(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    session = state_manager.get_or_create_session(user_id)
+    await callback.answer()
     
     try:
-        question = await openai_client.generate_question(
-            session.preferences,
-            state_manager.get_conversation_history(user_id, limit=10)
-        )
-        
-        state_manager.add_message(user_id, "assistant", question)
-        await callback.message.edit_text(question)
-        await callback.answer()
+        await send_question(callback.message, user_id, edit=True)
         
     except Exception as e:
         logging.error(f"Error generating more questions: {e}")
         await callback.message.edit_text("Расскажи подробнее о своих предпочтениях!")
-        await callback.answer()
 
 
-async def show_search_results(message: types.Message, places, user_id: int):
+async def show_search_results(message: types.Message, places, user_id: int, offset: int = 0):
     if not places:
         await message.answer("Места не найдены.")
         return
     
-    results_text = "🎯 Вот что я нашел для тебя:\n\n"
+    session = state_manager.get_or_create_session(user_id)
+    results_text = "🎯 Вот что я нашел для тебя:\n\n" if offset == 0 else "🎯 Еще варианты:\n\n"
     
-    for i, place in enumerate(places[:3], 1):
+    for i, place in enumerate(places[offset:offset + RESULTS_PAGE_SIZE], offset + 1):
         results_text += f"{i}. {gis_client.format_place_for_user(place)}\n"
     
-    await message.answer(results_text)
+    keyboard = None
+    if offset + RESULTS_PAGE_SIZE < len(places) or session.has_more_pages:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="➡️ Ещё варианты", callback_data="more_results")]
+        ])
+    
+    await message.answer(results_text, reply_markup=keyboard)
+    
+    # Если следующая страница окна последняя, заранее подгружаем результаты 2ГИС
+    if len(places) - offset <= 2 * RESULTS_PAGE_SIZE:
+        await schedule_next_page(user_id)
+
+
+async def schedule_next_page(user_id: int) -> Optional[asyncio.Task]:
+    session = state_manager.get_or_create_session(user_id)
+    if not session.has_more_pages:
+        return None
+    if session.next_page_task is not None and not session.next_page_task.done():
+        return session.next_page_task
+    
+    task = await user_queue.spawn(fetch_next_page(
+        user_id,
+        session.preferences,
+        session.current_location,
+        session.result_page + 1
+    ))
+    if task is not None:
+        state_manager.set_next_page_task(user_id, task)
+    return task
+
+
+async def fetch_next_page(user_id: int, preferences, location, page: int) -> None:
+    try:
+        places = await search_planner.search(
+            preferences,
+            location,
+            radius=5000,
+            limit=settings.ranking.candidate_pool,
+            page=page
+        )
+    except Exception as e:
+        logging.error(f"Error fetching next results page: {e}")
+        return
+    
+    state_manager.extend_search_results(
+        user_id,
+        rank_places(places, location, preferences, ranking_weights),
+        page=page,
+        has_more_pages=len(places) >= settings.ranking.candidate_pool
+    )
+
+
+@dp.callback_query(lambda c: c.data == "more_results")
+async def more_results(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    session = state_manager.get_or_create_session(user_id)
+    offset = session.result_offset + RESULTS_PAGE_SIZE
+    
+    if offset >= len(session.last_search_results):
+        # Окно закончилось: дожидаемся фоновой загрузки следующей страницы
+        # Завершенная задача могла ничего не добавить (ошибка 2ГИС): тогда загружаем заново
+        task = session.next_page_task
+        if task is None or task.done():
+            task = await schedule_next_page(user_id)
+        if task is not None:
+            await callback.answer("🔍 Ищу еще варианты...")
+            await asyncio.gather(task, return_exceptions=True)
+        elif session.has_more_pages:
+            # Свободных слотов нет: загружаем страницу в слоте этого обновления
+            await callback.answer("🔍 Ищу еще варианты...")
+            await fetch_next_page(user_id, session.preferences, session.current_location, session.result_page + 1)
+        else:
+            await callback.answer()
+    else:
+        await callback.answer()
+    
+    if offset >= len(session.last_search_results):
+        await callback.message.answer("😔 Больше вариантов не нашлось. Попробуй изменить критерии поиска через /start.")
+        return
+    
+    state_manager.set_result_offset(user_id, offset)
+    await show_search_results(callback.message, session.last_search_results, user_id, offset)
 
 
 
+@dp.message(Command("popular"))
+async def popular_nearby(message: types.Message):
+    user_id = message.from_user.id
+    session = state_manager.get_or_create_session(user_id)
+    
+    if not session.current_location:
+        await message.answer("📍 Сначала поделись местоположением через /start, и я покажу популярные места рядом.")
+        return
+    
+    try:
+        # Поиск без критериев отвечается из фоново обновляемых тайлов популярных мест
+        places = await search_places_for(UserPreferences(), session.current_location)
+    except Exception as e:
+        logging.error(f"Error during popular places search: {e}")
+        await message.answer("Произошла ошибка при поиске. Попробуй еще раз.")
+        return
+    
+    if not places:
+        await message.answer("😔 Рядом пока не нашлось популярных мест.")
+        return
+    
+    results_text = "🔥 Популярные места рядом:\n\n"
+    for i, place in enumerate(places[:RESULTS_PAGE_SIZE], 1):
+        results_text += f"{i}. {gis_client.format_place_for_user(place)}\n"
+    await message.answer(results_text)
+
+
 @dp.message(Command("help"))
 async def help_command(message: types.Message):
     help_text = """🤖 <b>Помощь по Акинатору мест</b>
@@ -210,6 +521,7 @@ async def help_command(message: types.Message):
 
 📍 <b>Команды:</b>
 /start - Начать новый поиск
+/popular - Популярные места рядом без вопросов
 /help - Показать эту справку
 
 🔍 <b>Что я учитываю:</b>
@@ -0,0 +1,88 @@
+import time
+import logging
+from typing import AsyncIterator, Optional
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+
+async def answer_streamed(
+    message: types.Message,
+    chunks: AsyncIterator[str],
+    edit: bool = False,
+    edit_interval: float = 1.0,
+    first_chunk_chars: int = 40,
+    reply_markup: Optional[types.InlineKeyboardMarkup] = None
+) -> str:
+    """Показывает потоковый ответ модели, редактируя одно сообщение.
+
+    Первое сообщение отправляется, как только накопится first_chunk_chars символов,
+    дальше текст дописывается правками не чаще одной в edit_interval секунд,
+    чтобы не упираться в ограничения Telegram на редактирование. При edit=True
+    вместо нового сообщения редактируется переданное. Возвращает итоговый текст.
+    """
+    text = ""
+    shown_text = None
+    target = message if edit else None
+    last_edit = 0.0
+
+    try:
+        async for chunk in chunks:
+            text += chunk
+            if not text.strip():
+                continue
+
+            if target is None or shown_text is None:
+                if len(text) < first_chunk_chars:
+                    continue
+            elif time.monotonic() - last_edit < edit_interval:
+                continue
+
+            target = await _show(message, target, text, edit)
+            shown_text = text
+            last_edit = time.monotonic()
+    finally:
+        # При ошибке показа генератор закрывается сразу, а не при сборке мусора
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    if not text.strip():
+        return text
+
+    if text != shown_text:
+        # Финальная версия отправляется всегда, даже если интервал еще не прошел
+        await _show(message, target, text, edit, reply_markup=reply_markup, final=True)
+    elif reply_markup is not None:
+        await target.edit_reply_markup(reply_markup=reply_markup)
+
+    return text
+
+
+async def _show(
+    message: types.Message,
+    target: Optional[types.Message],
+    text: str,
+    edit: bool,
+    reply_markup: Optional[types.InlineKeyboardMarkup] = None,
+    final: bool = False
+) -> types.Message:
+    if target is None:
+        return await message.answer(text, reply_markup=reply_markup)
+
+    try:
+        result = await target.edit_text(text, reply_markup=reply_markup)
+    except TelegramRetryAfter as e:
+        if not final:
+            # Промежуточную правку можно пропустить, следующая ее перекроет
+            logging.warning(f"Stream edit throttled by Telegram for {e.retry_after}s")
+            return target
+        raise
+    except TelegramBadRequest as e:
+        # Неполный HTML в промежуточном тексте или "message is not modified"
+        if final:
+            raise
+        logging.debug(f"Skipping stream edit: {e}")
+        return target
+
+    return result if isinstance(result, types.Message) else target
@@ -0,0 +1,275 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+
+# Границы корзин гистограмм задержки в секундах: от кэша до долгих ответов LLM
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def error_status(error: BaseException) -> str:
+    """Метка статуса для неуспешного вызова: HTTP-код, если он известен, иначе имя исключения."""
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    return str(status) if isinstance(status, int) else type(error).__name__
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["_Metric"] = []
+
+    def register(self, metric: "_Metric") -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            try:
+                metric.render(lines)
+            except Exception as e:
+                logging.error(f"Error rendering metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Registry = registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def render(self, lines: List[str]) -> None:
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+
+
+class Counter(_Metric):
+    """Монотонный счетчик. С fn значение читается из объекта при каждом сборе."""
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        fn: Optional[Callable[[], float]] = None,
+        registry: Registry = registry
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.fn = fn
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self, lines: List[str]) -> None:
+        super().render(lines)
+        if self.fn is not None:
+            lines.append(f"{self.name} {_format_value(self.fn())}")
+            return
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Registry = registry
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        # На каждый набор меток: счетчики по корзинам (последняя - +Inf), сумма, количество
+        self._series: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self, lines: List[str]) -> None:
+        super().render(lines)
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds",
+    "Время выполнения обработчиков бота",
+    ["handler", "status"]
+)
+UPSTREAM_SECONDS = Histogram(
+    "upstream_request_seconds",
+    "Время одной попытки запроса к внешнему API",
+    ["upstream", "status"]
+)
+UPSTREAM_WAIT_SECONDS = Histogram(
+    "upstream_wait_seconds",
+    "Ожидание квоты и слота параллелизма перед запросом к внешнему API",
+    ["upstream"]
+)
+OPENAI_SECONDS = Histogram(
+    "openai_request_seconds",
+    "Время запроса к OpenAI с повторами (для потоков - до начала ответа)",
+    ["model", "status"]
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total",
+    "Токены OpenAI по usage ответа; для потоковых ответов - локальная оценка",
+    ["model", "kind"]
+)
+UPSTREAM_REJECTED = Counter(
+    "upstream_rejected_total",
+    "Вызовы, отклоненные открытым circuit breaker",
+    ["upstream"]
+)
+UPSTREAM_HEDGED = Counter(
+    "upstream_hedged_total",
+    "Дублирующие (hedged) запросы и какой из запросов ответил первым",
+    ["upstream", "winner"]
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "upstream_circuit_open",
+    "1, если circuit breaker внешнего API открыт или пропускает пробный запрос",
+    ["upstream"]
+)
+OUTBOUND_WAIT_SECONDS = Histogram(
+    "telegram_outbound_wait_seconds",
+    "Время запроса к Telegram в очереди исходящих до отправки",
+    ["priority"]
+)
+OUTBOUND_RETRY_AFTER = Counter(
+    "telegram_retry_after_total",
+    "Ответы Telegram с RetryAfter, повторенные очередью исходящих",
+    ["method"]
+)
+LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds",
+    "Опоздание пробуждения таймера в event loop",
+    buckets=LOOP_LAG_BUCKETS
+)
+
+
+class Timer:
+    """Замеряет длительность блока и записывает ее в гистограмму с меткой статуса."""
+
+    __slots__ = ("histogram", "labels", "status", "_started")
+
+    def __init__(self, histogram: Histogram, *labels: str):
+        self.histogram = histogram
+        self.labels = labels
+        self.status = "ok"
+
+    def __enter__(self) -> "Timer":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None and self.status == "ok":
+            self.status = error_status(exc)
+        self.histogram.observe(time.perf_counter() - self._started, *self.labels, self.status)
+
+
+class LoopLagMonitor:
+    """Фоновая задача, измеряющая задержку event loop по опозданию asyncio.sleep."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - self.interval))
+
+
+class MetricsServer:
+    """HTTP-эндпоинт с метриками в текстовом формате Prometheus."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9090, path: str = "/metrics", registry: Registry = registry):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Metrics are served on http://{self.host}:{self.port}{self.path}")
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
@@ -0,0 +1,6 @@
+from .metrics import HandlerMetricsMiddleware
+from .outbound import OutboundQueueMiddleware
+from .session_loader import SessionLoadMiddleware
+from .user_queue import UserQueueMiddleware
+
+__all__ = ['HandlerMetricsMiddleware', 'OutboundQueueMiddleware', 'SessionLoadMiddleware', 'UserQueueMiddleware']
@@ -0,0 +1,25 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from root_packages.metrics import HANDLER_SECONDS, Timer
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время выполнения обработчиков по имени функции-обработчика и статусу.
+
+    Регистрируется как внутренний middleware (dp.message.middleware), чтобы
+    обработчик уже был выбран фильтрами и лежал в data["handler"].
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "unknown") if handler_object else "unknown"
+        with Timer(HANDLER_SECONDS, name):
+            return await handler(event, data)
@@ -0,0 +1,257 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageReplyMarkup, EditMessageText, Response, SendChatAction, TelegramMethod
+
+from root_packages.metrics import OUTBOUND_RETRY_AFTER, OUTBOUND_WAIT_SECONDS
+
+
+# Чем меньше число, тем раньше запрос уходит, когда упираемся в общий лимит
+PRIORITY_INTERACTIVE = 0
+PRIORITY_EDIT = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_EDIT: "edit", PRIORITY_BACKGROUND: "background"}
+
+# Правки, которые можно схлопнуть: более поздняя полностью задает итоговое состояние сообщения
+MERGEABLE_EDITS = (EditMessageText, EditMessageReplyMarkup)
+
+
+def method_priority(method: TelegramMethod) -> int:
+    if isinstance(method, SendChatAction):
+        return PRIORITY_BACKGROUND
+    if isinstance(method, MERGEABLE_EDITS):
+        return PRIORITY_EDIT
+    return PRIORITY_INTERACTIVE
+
+
+class _Request:
+    __slots__ = ("method", "make_request", "bot", "priority", "seq", "enqueued_at", "futures")
+
+    def __init__(self, method: TelegramMethod, make_request: NextRequestMiddlewareType, bot: Bot, seq: int):
+        self.method = method
+        self.make_request = make_request
+        self.bot = bot
+        self.priority = method_priority(method)
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        # Несколько вызывающих, если их правки были объединены в одну
+        self.futures: List[asyncio.Future] = [asyncio.get_running_loop().create_future()]
+
+
+class _Chat:
+    """Очередь чата и его token bucket: burst запросов сразу, дальше rate в секунду."""
+
+    __slots__ = ("requests", "rate", "burst", "tokens", "updated_at", "paused_until", "busy")
+
+    def __init__(self, rate: float, burst: int):
+        self.requests: Deque[_Request] = deque()
+        self.rate = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.busy = False
+
+    def ready_in(self, now: float) -> float:
+        """Через сколько секунд чату можно отправить следующий запрос."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def idle(self, now: float) -> bool:
+        # Чат удаляется, только когда его bucket восстановился полностью
+        return not self.requests and not self.busy and self.ready_in(now) == 0.0 and self.tokens >= self.burst
+
+
+class OutboundQueueMiddleware(BaseRequestMiddleware):
+    """Очередь исходящих запросов бота с учетом ограничений Telegram.
+
+    Запросы с chat_id (отправка, правка, удаление сообщений) ставятся в очередь
+    своего чата и уходят не чаще global_rate в секунду в сумме, не чаще
+    chat_rate в секунду в личный чат и group_rate_per_minute в минуту в группу;
+    в пределах chat_burst запросов подряд чат не ждет, так что первые ответы хода
+    уходят сразу.
+    Внутри чата порядок сохраняется, следующий запрос ждет ответа на предыдущий;
+    между чатами первым уходит запрос с более высоким приоритетом: ответы
+    пользователю, затем правки, затем статусы "печатает". Еще не отправленная
+    правка сообщения заменяется более новой правкой того же сообщения. На
+    TelegramRetryAfter чат ставится на паузу, и запрос повторяется сам.
+
+    Остальные методы (getUpdates, answerCallbackQuery, setWebhook...) идут напрямую.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        group_rate_per_minute: float = 20.0,
+        chat_burst: int = 3
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate_per_minute = group_rate_per_minute
+        self.chat_burst = chat_burst
+        self._chats: Dict[Union[int, str], _Chat] = {}
+        self._seq = 0
+        self._global_next_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(chat.requests) for chat in self._chats.values())
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod
+    ) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        if self._task is None:
+            # Задача создается в event loop, где бот реально работает
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self._chat_rate(chat_id), self.chat_burst)
+
+        merged = self._merge(chat, method)
+        if merged is not None:
+            return await merged
+
+        self._seq += 1
+        request = _Request(method, make_request, bot, self._seq)
+        chat.requests.append(request)
+        self._wakeup.set()
+        return await request.futures[0]
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        for chat in self._chats.values():
+            for request in chat.requests:
+                for future in request.futures:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Outbound queue is closed"))
+        self._chats.clear()
+
+    def _chat_rate(self, chat_id: Union[int, str]) -> float:
+        # Отрицательные id и @username - группы и каналы, у них лимит строже
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.chat_rate
+        return self.group_rate_per_minute / 60
+
+    def _merge(self, chat: _Chat, method: TelegramMethod) -> Optional[asyncio.Future]:
+        if not isinstance(method, MERGEABLE_EDITS) or method.message_id is None:
+            return None
+        for request in reversed(chat.requests):
+            queued = request.method
+            if not isinstance(queued, MERGEABLE_EDITS):
+                # Правку нельзя переносить через другой запрос в этот чат
+                return None
+            if queued.message_id != method.message_id:
+                continue
+            if type(queued) is not type(method):
+                # Между правками того же сообщения стоит правка другого вида: порядок важен
+                return None
+            request.method = method
+            future = asyncio.get_running_loop().create_future()
+            request.futures.append(future)
+            return future
+        return None
+
+    def _pick(self, now: float) -> Tuple[Optional[_Chat], Optional[float]]:
+        """Чат, чей запрос уходит следующим, или время до готовности ближайшего."""
+        best = None
+        best_key = None
+        delay = None
+        empty = []
+        for chat_id, chat in self._chats.items():
+            if not chat.requests:
+                if chat.idle(now):
+                    empty.append(chat_id)
+                continue
+            if chat.busy:
+                continue
+            ready_in = chat.ready_in(now)
+            if ready_in > 0:
+                delay = ready_in if delay is None else min(delay, ready_in)
+                continue
+            head = chat.requests[0]
+            key = (head.priority, head.seq)
+            if best_key is None or key < best_key:
+                best, best_key = chat, key
+        # Чаты без запросов и без действующей паузы больше не нужны
+        for chat_id in empty:
+            del self._chats[chat_id]
+        return best, delay
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            if self._global_next_at > now:
+                await asyncio.sleep(self._global_next_at - now)
+                continue
+
+            chat, delay = self._pick(now)
+            if chat is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            request = chat.requests.popleft()
+            chat.busy = True
+            chat.tokens -= 1
+            self._global_next_at = now + 1 / self.global_rate
+            task = asyncio.create_task(self._send(chat, request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat: _Chat, request: _Request) -> None:
+        OUTBOUND_WAIT_SECONDS.observe(time.monotonic() - request.enqueued_at, PRIORITY_NAMES[request.priority])
+        try:
+            result: Any = await request.make_request(request.bot, request.method)
+        except TelegramRetryAfter as e:
+            OUTBOUND_RETRY_AFTER.inc(type(request.method).__name__)
+            logging.warning(f"Telegram flood control for chat {request.method.chat_id}, retrying in {e.retry_after}s")
+            # Запрос возвращается в начало очереди чата, порядок сообщений не меняется
+            chat.requests.appendleft(request)
+            chat.paused_until = time.monotonic() + e.retry_after
+        except asyncio.CancelledError:
+            for future in request.futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in request.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
@@ -0,0 +1,28 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class SessionLoadMiddleware(BaseMiddleware):
+    """Подгружает сессию пользователя из хранилища до обработчика.
+
+    Чтение выполняется в пуле потоков, поэтому промах кэша сессий не
+    блокирует event loop; обработчики затем находят сессию в памяти.
+    Регистрируется после UserQueueMiddleware, чтобы загрузка шла под
+    очередью пользователя.
+    """
+
+    def __init__(self, state_manager):
+        self.state_manager = state_manager
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None:
+            await self.state_manager.preload_session(user.id)
+        return await handler(event, data)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Optional, Set
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+
+class UserQueueMiddleware(BaseMiddleware):
+    """Последовательная обработка обновлений одного пользователя.
+
+    Обновления разных пользователей обрабатываются параллельно, но не более
+    max_in_flight одновременно. Если у пользователя уже max_user_queue
+    необработанных обновлений или общая очередь длиннее max_waiting,
+    обновление отклоняется с ответом "занят".
+
+    Фоновые задачи обработчиков (spawn) занимают слоты того же лимита и
+    отменяются в close().
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 64,
+        max_user_queue: int = 3,
+        max_waiting: int = 1000,
+        busy_text: str = "⏳ Я еще думаю над предыдущим сообщением, подожди немного!"
+    ):
+        self.max_user_queue = max_user_queue
+        self.max_waiting = max_waiting
+        self.busy_text = busy_text
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = {}
+        self._waiting = 0
+        self._background: Set[asyncio.Task] = set()
+        self._closed = False
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    async def spawn(self, coro: Coroutine[Any, Any, Any]) -> Optional[asyncio.Task]:
+        """Запускает фоновую задачу в слоте общего лимита.
+
+        Задача не ждет слот: если свободных нет, корутина закрывается и
+        возвращается None. Иначе обработчик, ожидающий задачу, мог бы держать
+        последний слот, который ей нужен.
+        """
+        if self._closed or self._semaphore.locked():
+            coro.close()
+            return None
+        # Слот свободен, поэтому acquire завершается без ожидания
+        await self._semaphore.acquire()
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+        return task
+
+    async def close(self) -> None:
+        """Отменяет фоновые задачи и дожидается их завершения."""
+        self._closed = True
+        tasks = list(self._background)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        self._background.discard(task)
+        self._semaphore.release()
+        # Исключение забирается здесь, даже если результат задачи никому не понадобился
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Background task failed: {task.exception()}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        user_id = user.id
+        pending = self._pending.get(user_id, 0)
+        if pending >= self.max_user_queue or self._waiting >= self.max_waiting:
+            logging.warning(f"Shedding update for user {user_id}: pending={pending}, waiting={self._waiting}")
+            await self._reply_busy(event)
+            return None
+
+        self._pending[user_id] = pending + 1
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._waiting += 1
+        waiting = True
+        try:
+            # asyncio.Lock выдает доступ в порядке очереди, поэтому порядок обновлений сохраняется
+            async with lock:
+                async with self._semaphore:
+                    self._waiting -= 1
+                    waiting = False
+                    return await handler(event, data)
+        finally:
+            if waiting:
+                self._waiting -= 1
+            self._pending[user_id] -= 1
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+                del self._locks[user_id]
+
+    async def _reply_busy(self, event: TelegramObject) -> None:
+        if not isinstance(event, Update):
+            return
+        try:
+            if event.message:
+                await event.message.answer(self.busy_text)
+            elif event.callback_query:
+                await event.callback_query.answer(self.busy_text)
+        except Exception as e:
+            logging.error(f"Error sending busy reply: {e}")
@@ -1,5 +1,25 @@
+from typing import Optional
+
 from aiogram.client.bot import Bot, DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from root_packages.middleware import OutboundQueueMiddleware
 from settings import settings
 
 
-bot = Bot(settings.bot.bot_token, default=DefaultBotProperties(parse_mode='HTML'))
+outbound_queue = OutboundQueueMiddleware(
+    global_rate=settings.outbound.global_rate,
+    chat_rate=settings.outbound.chat_rate,
+    group_rate_per_minute=settings.outbound.group_rate_per_minute,
+    chat_burst=settings.outbound.chat_burst
+)
+
+
+def create_bot(session: Optional[BaseSession] = None) -> Bot:
+    """Бот с общими настройками; исходящие запросы идут через outbound_queue."""
+    bot = Bot(settings.bot.bot_token, session=session, default=DefaultBotProperties(parse_mode='HTML'))
+    if settings.outbound.enabled:
+        bot.session.middleware(outbound_queue)
+    return bot
+
+
+bot = create_bot()
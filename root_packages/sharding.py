@@ -0,0 +1,303 @@
+import time
+import zlib
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+
+def update_user_id(payload: Dict) -> Optional[int]:
+    """id пользователя из сырого обновления Telegram (без разбора в модели aiogram)."""
+    for key, value in payload.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def shard_for(user_id: Optional[int], shards: int) -> int:
+    if user_id is None:
+        return 0
+    # crc32 стабилен между процессами и запусками, в отличие от hash() для строк
+    return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % shards
+
+
+class Shard:
+    __slots__ = (
+        "index", "port", "process", "queue", "overflow", "overflow_size", "rejected",
+        "started_at", "last_healthy", "restarts", "restart_delay"
+    )
+
+    def __init__(self, index: int, port: int, queue_size: int, overflow_size: int):
+        self.index = index
+        self.port = port
+        self.process: Optional[multiprocessing.Process] = None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # Обновления сверх очереди (polling): ждут, пока воркер перезапустится
+        self.overflow: Deque[Dict] = deque()
+        self.overflow_size = overflow_size
+        self.rejected = 0
+        self.started_at = 0.0
+        self.last_healthy = 0.0
+        self.restarts = 0
+        self.restart_delay = 0.0
+
+
+class ShardSupervisor:
+    """Распределяет обновления по процессам-воркерам по хэшу user_id.
+
+    Каждый воркер - отдельный процесс со своим dp и state_manager, который
+    принимает обновления на локальном порту (base_port + номер шарда). У каждого
+    шарда своя очередь и задача доставки, поэтому упавший или перезапускаемый
+    воркер задерживает только обновления своих пользователей. Супервизор
+    опрашивает health воркеров и перезапускает процесс, если он завершился,
+    не поднялся за startup_timeout или дольше heartbeat_timeout не отвечает.
+
+    target(index, port, secret_token) выполняется в дочернем процессе (spawn).
+    Сессии переживают перезапуск воркера только при включенном STATE_DB_PATH.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int, int, str], None],
+        shards: int,
+        base_port: int = 8100,
+        path: str = "/webhook",
+        health_path: str = "/health",
+        secret_token: str = "",
+        heartbeat_interval: float = 2.0,
+        heartbeat_timeout: float = 10.0,
+        startup_timeout: float = 60.0,
+        restart_delay: float = 1.0,
+        restart_delay_max: float = 30.0,
+        queue_size: int = 1000,
+        overflow_size: int = 10000
+    ):
+        self.target = target
+        self.path = path
+        self.health_path = health_path
+        self.secret_token = secret_token
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.restart_delay = restart_delay
+        self.restart_delay_max = restart_delay_max
+        self.shards = [Shard(index, base_port + index, queue_size, overflow_size) for index in range(shards)]
+        # spawn: дочерний процесс не наследует event loop и открытые соединения родителя
+        self._context = multiprocessing.get_context("spawn")
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._tasks: List[asyncio.Task] = []
+        # Перезапуск шарда - отдельная задача, чтобы не задерживать проверки остальных
+        self._restarts: Dict[int, asyncio.Task] = {}
+
+    async def start(self) -> None:
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        for shard in self.shards:
+            self._spawn(shard)
+            self._tasks.append(asyncio.create_task(self._forward(shard)))
+        self._tasks.append(asyncio.create_task(self._monitor()))
+
+    async def close(self) -> None:
+        tasks = self._tasks + list(self._restarts.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._restarts = {}
+        await asyncio.gather(*(self._stop(shard) for shard in self.shards))
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def dispatch(self, payload: Dict, overflow: bool = False) -> bool:
+        """Ставит обновление в очередь его шарда, никогда не ожидая.
+
+        Если очередь полна, с overflow обновление откладывается в запасной буфер
+        шарда, иначе (и при полном буфере) возвращается False.
+        """
+        shard = self.shards[shard_for(update_user_id(payload), len(self.shards))]
+        if not shard.overflow:
+            try:
+                shard.queue.put_nowait(payload)
+                return True
+            except asyncio.QueueFull:
+                pass
+        if overflow and len(shard.overflow) < shard.overflow_size:
+            shard.overflow.append(payload)
+            return True
+        shard.rejected += 1
+        logging.warning(f"Shard {shard.index} queue is full, update rejected")
+        return False
+
+    def health(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "shards": [
+                {
+                    "index": shard.index,
+                    "alive": shard.process is not None and shard.process.is_alive(),
+                    "healthy": bool(shard.last_healthy) and now - shard.last_healthy < self.heartbeat_timeout,
+                    "queue": shard.queue.qsize() + len(shard.overflow),
+                    "rejected": shard.rejected,
+                    "restarts": shard.restarts
+                }
+                for shard in self.shards
+            ]
+        }
+
+    def _spawn(self, shard: Shard) -> None:
+        shard.process = self._context.Process(
+            target=self.target,
+            args=(shard.index, shard.port, self.secret_token),
+            name=f"shard-{shard.index}",
+            daemon=True
+        )
+        shard.process.start()
+        shard.started_at = time.monotonic()
+        # 0 - воркер еще ни разу не ответил на health
+        shard.last_healthy = 0.0
+        logging.info(f"Started shard {shard.index} (pid {shard.process.pid}) on port {shard.port}")
+
+    async def _stop(self, shard: Shard) -> None:
+        process = shard.process
+        if process is None:
+            return
+        if process.is_alive():
+            # SIGTERM: воркер корректно завершает dp и сбрасывает сессии в storage
+            process.terminate()
+            await asyncio.to_thread(process.join, 15)
+        if process.is_alive():
+            logging.warning(f"Shard {shard.index} did not stop in time, killing it")
+            process.kill()
+            await asyncio.to_thread(process.join)
+        process.close()
+        shard.process = None
+
+    async def _restart(self, shard: Shard, reason: str) -> None:
+        # Воркер, падающий до первого успешного health, перезапускается со все большей паузой
+        if not shard.last_healthy:
+            shard.restart_delay = min(self.restart_delay_max, max(self.restart_delay, shard.restart_delay * 2))
+        else:
+            shard.restart_delay = self.restart_delay
+        logging.error(f"Restarting shard {shard.index} in {shard.restart_delay:.1f}s: {reason}")
+
+        await self._stop(shard)
+        await asyncio.sleep(shard.restart_delay)
+        shard.restarts += 1
+        self._spawn(shard)
+
+    def _schedule_restart(self, shard: Shard, reason: str) -> None:
+        task = asyncio.create_task(self._restart(shard, reason))
+        self._restarts[shard.index] = task
+        task.add_done_callback(lambda _: self._restarts.pop(shard.index, None))
+
+    async def _monitor(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await asyncio.gather(*(self._check(shard) for shard in self.shards))
+
+    async def _check(self, shard: Shard) -> None:
+        if shard.process is None or shard.index in self._restarts:
+            return
+        if not shard.process.is_alive():
+            self._schedule_restart(shard, f"process exited with code {shard.process.exitcode}")
+            return
+
+        try:
+            async with self._session.get(
+                f"http://127.0.0.1:{shard.port}{self.health_path}",
+                timeout=aiohttp.ClientTimeout(total=self.heartbeat_interval)
+            ) as response:
+                if response.status == 200:
+                    shard.last_healthy = time.monotonic()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+        now = time.monotonic()
+        if not shard.last_healthy:
+            if now - shard.started_at > self.startup_timeout:
+                self._schedule_restart(shard, f"not ready after {self.startup_timeout:.0f}s")
+        elif now - shard.last_healthy > self.heartbeat_timeout:
+            self._schedule_restart(shard, f"no healthy heartbeat for {self.heartbeat_timeout:.0f}s")
+
+    async def _forward(self, shard: Shard) -> None:
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret_token} if self.secret_token else {}
+        while True:
+            payload = await shard.queue.get()
+            # Освободилось место: переносим отложенное обновление, сохраняя порядок
+            if shard.overflow:
+                shard.queue.put_nowait(shard.overflow.popleft())
+            delay = 0.1
+            # Пока воркер перезапускается, обновление ждет его, не блокируя другие шарды
+            while True:
+                try:
+                    async with self._session.post(
+                        f"http://127.0.0.1:{shard.port}{self.path}",
+                        json=payload,
+                        headers=headers
+                    ) as response:
+                        if response.status < 500:
+                            if response.status != 200:
+                                logging.error(f"Shard {shard.index} rejected update with status {response.status}")
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+
+
+async def run_polling_supervisor(supervisor: ShardSupervisor, bot, allowed_updates: List[str]) -> None:
+    """Long polling в процессе-супервизоре с раздачей обновлений по шардам."""
+    await bot.delete_webhook()
+    await supervisor.start()
+    offset: Optional[int] = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception as e:
+                logging.error(f"Error polling updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                # Очередь недоступного шарда копится в его буфере и не останавливает опрос
+                # для остальных; при переполнении буфера обновление теряется (см. dispatch)
+                supervisor.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True), overflow=True)
+                offset = update.update_id + 1
+    finally:
+        await supervisor.close()
+        await bot.session.close()
+
+
+def build_supervisor_app(supervisor: ShardSupervisor, path: str, health_path: str, secret_token: str) -> web.Application:
+    """Webhook-приложение супервизора: сырой JSON обновления сразу уходит в шард."""
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except Exception as e:
+            logging.warning(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+        # 503 - Telegram повторит доставку, когда очередь шарда освободится
+        return web.Response(status=200 if supervisor.dispatch(payload) else 503)
+
+    async def health(request: web.Request) -> web.Response:
+        report = supervisor.health()
+        healthy = all(shard["healthy"] for shard in report["shards"])
+        return web.json_response({"status": "ok" if healthy else "degraded", **report}, status=200 if healthy else 503)
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get(health_path, health)
+    return app
@@ -0,0 +1,79 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+
+class SessionStorage(ABC):
+    """Интерфейс постоянного хранилища сессий. Сессии передаются в виде словарей."""
+
+    @abstractmethod
+    def load(self, user_id: int) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def save_many(self, records: Dict[int, Optional[Dict]]) -> None:
+        """Сохраняет пачку сессий одной транзакцией; None означает удаление."""
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStorage(SessionStorage):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Запись выполняется из пула потоков, чтение - из цикла событий
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+        # Отдельное соединение для чтения: в WAL оно не ждет транзакцию записи,
+        # поэтому промах кэша не блокирует цикл событий на время flush
+        self._read_lock = threading.Lock()
+        self._read_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+    def load(self, user_id: int) -> Optional[Dict]:
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT data FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, records: Dict[int, Optional[Dict]]) -> None:
+        if not records:
+            return
+        upserts = [
+            (user_id, json.dumps(data, ensure_ascii=False), data.get("updated_at", time.time()))
+            for user_id, data in records.items() if data is not None
+        ]
+        deletes = [(user_id,) for user_id, data in records.items() if data is None]
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                        upserts
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self._read_lock:
+            self._read_conn.close()
+        with self._lock:
+            self._conn.close()
@@ -1,80 +1,373 @@
-from typing import Dict, List, Optional
-from dataclasses import dataclass, field
-from datetime import datetime
+import sys
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from dataclasses import asdict
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
 from root_packages.api import UserPreferences, Place
+from root_packages.api.openai_client import preferences_key, wrap_user_message
+from root_packages.api.tokens import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+from settings import settings
+from .storage import SessionStorage, SQLiteStorage
 
 
-@dataclass
 class ConversationMessage:
-    role: str  # 'user' или 'assistant'
-    content: str
-    timestamp: datetime = field(default_factory=datetime.now)
+    __slots__ = ("role", "content", "timestamp", "tokens")
+
+    def __init__(self, role: str, content: str, timestamp: Optional[float] = None):
+        self.role = role  # 'user' или 'assistant'
+        self.content = content
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        # Оценка считается по тексту в том виде, в каком он уйдет модели; сама
+        # обертка не хранится и строится PromptBuilder при отправке
+        prompt_content = wrap_user_message(content) if role == "user" else content
+        self.tokens = estimate_tokens(prompt_content) + MESSAGE_OVERHEAD_TOKENS
 
 
-@dataclass 
 class UserSession:
-    user_id: int
-    preferences: UserPreferences = field(default_factory=UserPreferences)
-    conversation_history: List[ConversationMessage] = field(default_factory=list)
-    current_location: Optional[Dict[str, float]] = None
-    last_search_results: List[Place] = field(default_factory=list)
-    state: str = "initial"  # initial, collecting_preferences, searching, refining
-    created_at: datetime = field(default_factory=datetime.now)
-    updated_at: datetime = field(default_factory=datetime.now)
+    __slots__ = (
+        "user_id", "preferences", "conversation_history", "current_location",
+        "last_search_results", "state", "created_at", "updated_at", "summary", "summary_prompt",
+        "prefetch_key", "prefetch_task", "result_offset", "result_page", "has_more_pages",
+        "next_page_task"
+    )
+
+    def __init__(self, user_id: int, history_size: int = 50):
+        now = time.time()
+        self.user_id = user_id
+        self.preferences = UserPreferences()
+        # Кольцевой буфер: старые сообщения вытесняются автоматически
+        self.conversation_history: Deque[ConversationMessage] = deque(maxlen=history_size)
+        self.current_location: Optional[Dict[str, float]] = None
+        self.last_search_results: Sequence[Place] = ()
+        self.state = "initial"  # initial, collecting_preferences, searching, refining
+        self.created_at = now
+        self.updated_at = now
+        # Краткое содержание свернутых старых реплик и готовое системное сообщение с ним
+        self.summary = ""
+        self.summary_prompt: Optional[Dict] = None
+        # Фоновый поиск, запущенный заранее для снимка предпочтений и локации (не сохраняется)
+        self.prefetch_key: Optional[Tuple] = None
+        self.prefetch_task: Optional[asyncio.Task] = None
+        # Окно результатов: last_search_results - все загруженные места, result_offset -
+        # начало показанной страницы, result_page - последняя загруженная страница 2ГИС
+        self.result_offset = 0
+        self.result_page = 1
+        self.has_more_pages = False
+        self.next_page_task: Optional[asyncio.Task] = None
+
+
+def session_to_dict(session: UserSession) -> Dict:
+    return {
+        "user_id": session.user_id,
+        "preferences": asdict(session.preferences),
+        "conversation_history": [
+            [msg.role, msg.content, msg.timestamp] for msg in session.conversation_history
+        ],
+        "current_location": session.current_location,
+        "last_search_results": [asdict(place) for place in session.last_search_results],
+        "result_offset": session.result_offset,
+        "result_page": session.result_page,
+        "has_more_pages": session.has_more_pages,
+        "state": session.state,
+        "created_at": session.created_at,
+        "updated_at": session.updated_at,
+        "summary": session.summary
+    }
+
+
+def session_from_dict(data: Dict, history_size: int = 50) -> UserSession:
+    session = UserSession(user_id=data["user_id"], history_size=history_size)
+    session.preferences = UserPreferences(**data.get("preferences", {}))
+    session.conversation_history.extend(
+        ConversationMessage(role, content, timestamp)
+        for role, content, timestamp in data.get("conversation_history", [])
+    )
+    session.current_location = data.get("current_location")
+    session.last_search_results = tuple(Place(**place) for place in data.get("last_search_results", []))
+    session.result_offset = data.get("result_offset", 0)
+    session.result_page = data.get("result_page", 1)
+    session.has_more_pages = data.get("has_more_pages", False)
+    session.state = data.get("state", "initial")
+    # "searching" защищает от повторного нажатия, пока поиск идет в этом процессе;
+    # после перезапуска или вытеснения такого поиска уже нет
+    if session.state == "searching":
+        session.state = "collecting_preferences"
+    session.created_at = data.get("created_at", session.created_at)
+    session.updated_at = data.get("updated_at", session.updated_at)
+    set_session_summary(session, data.get("summary", ""))
+    return session
+
+
+def set_session_summary(session: UserSession, summary: str) -> None:
+    session.summary = summary
+    session.summary_prompt = {
+        "role": "system",
+        "content": f"Краткое содержание предыдущего диалога: {summary}"
+    } if summary else None
+
+
+def _deep_getsizeof(obj, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        size += sum(_deep_getsizeof(k, seen) + _deep_getsizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(_deep_getsizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += _deep_getsizeof(vars(obj), seen)
+
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += _deep_getsizeof(getattr(obj, slot), seen)
+    return size
 
 
 class UserStateManager:
-    def __init__(self):
-        self.sessions: Dict[int, UserSession] = {}
+    def __init__(
+        self,
+        max_sessions: int = 100_000,
+        idle_ttl: float = 6 * 3600,
+        history_size: int = 50,
+        memory_report_every: int = 10_000,
+        storage: Optional[SessionStorage] = None,
+        flush_interval: float = 2.0,
+        history_token_budget: int = 1200,
+        keep_last_messages: int = 4,
+        evicted_window_size: int = 6
+    ):
+        # Порядок словаря совпадает с порядком updated_at: в начале самые старые сессии
+        self.sessions: "OrderedDict[int, UserSession]" = OrderedDict()
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.history_size = history_size
+        self.memory_report_every = memory_report_every
+        self.created_count = 0
+        self.evicted_count = 0
+        # При превышении бюджета старые реплики сворачиваются в summary
+        self.history_token_budget = history_token_budget
+        self.keep_last_messages = keep_last_messages
+        # Сколько непросмотренных результатов сохранять у вытесненной сессии
+        self.evicted_window_size = evicted_window_size
+        # Сессии в памяти - горячий кэш поверх storage; изменения сбрасываются пачками
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self._dirty: set = set()
+        # Снимки вытесненных/удаленных сессий, еще не записанные в storage (None - удаление)
+        self._pending: Dict[int, Optional[Dict]] = {}
+        # Пачка, которая сейчас пишется в storage: до COMMIT читается отсюда, а не из базы
+        self._inflight: Dict[int, Optional[Dict]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        if self.storage is not None:
+            self.storage.close()
+
+    async def flush(self) -> int:
+        """Записывает все измененные сессии в storage одной транзакцией."""
+        if self.storage is None:
+            self._dirty.clear()
+            self._pending.clear()
+            return 0
+
+        records = self._pending
+        self._pending = {}
+        for user_id in self._dirty:
+            session = self.sessions.get(user_id)
+            if session is not None:
+                records[user_id] = session_to_dict(session)
+        self._dirty = set()
+
+        if not records:
+            return 0
+        self._inflight = records
+        try:
+            await asyncio.to_thread(self.storage.save_many, records)
+        except Exception as e:
+            logging.error(f"Error flushing sessions: {e}")
+            # Возвращаем неудачную пачку, не затирая более свежие изменения
+            for user_id, data in records.items():
+                if user_id not in self._dirty and user_id not in self._pending:
+                    self._pending[user_id] = data
+            return 0
+        finally:
+            self._inflight = {}
+        return len(records)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.evict_sessions()
+            await self.flush()
 
     def get_or_create_session(self, user_id: int) -> UserSession:
-        if user_id not in self.sessions:
-            self.sessions[user_id] = UserSession(user_id=user_id)
-        return self.sessions[user_id]
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self._add_session(self._load_session(user_id))
+        return session
+
+    async def preload_session(self, user_id: int) -> None:
+        """Загружает сессию из storage в пуле потоков, если ее нет в памяти.
+
+        После этого get_or_create_session находит сессию без синхронного
+        чтения SQLite в event loop.
+        """
+        if self.storage is None or user_id in self.sessions:
+            return
+        if user_id in self._pending or user_id in self._inflight:
+            # Несохраненный снимок читается из памяти без обращения к базе
+            return
+        try:
+            data = await asyncio.to_thread(self.storage.load, user_id)
+        except Exception as e:
+            logging.error(f"Error loading session {user_id}: {e}")
+            data = None
+        # Пока шло чтение, сессию могли создать или удалить (/start): их версия новее
+        if user_id in self.sessions or user_id in self._pending:
+            return
+        if data is not None:
+            self._add_session(session_from_dict(data, self.history_size))
+        else:
+            self._add_session(UserSession(user_id=user_id, history_size=self.history_size))
 
     def update_session(self, user_id: int, **kwargs) -> None:
         session = self.get_or_create_session(user_id)
         for key, value in kwargs.items():
             if hasattr(session, key):
                 setattr(session, key, value)
-        session.updated_at = datetime.now()
+        self._touch(session)
 
     def add_message(self, user_id: int, role: str, content: str) -> None:
         session = self.get_or_create_session(user_id)
         message = ConversationMessage(role=role, content=content)
         session.conversation_history.append(message)
-        session.updated_at = datetime.now()
+        self._touch(session)
 
     def get_conversation_history(self, user_id: int, limit: Optional[int] = None) -> List[Dict]:
+        """История в формате сообщений с исходным текстом реплик.
+
+        Очистку текста пользователя выполняет PromptBuilder при сборке запроса.
+        Если старые реплики уже свернуты, первым идет системное сообщение с их содержанием.
+        """
         session = self.get_or_create_session(user_id)
         history = session.conversation_history
-        
+
         if limit:
-            history = history[-limit:]
-            
-        return [
-            {"role": msg.role, "content": msg.content}
-            for msg in history
-        ]
+            history = islice(history, max(len(history) - limit, 0), None)
+
+        messages = [session.summary_prompt] if session.summary_prompt else []
+        messages.extend({"role": msg.role, "content": msg.content} for msg in history)
+        return messages
+
+    def take_overflow(self, user_id: int) -> List[Dict]:
+        """Если история превышает бюджет токенов, извлекает из нее все реплики,
+        кроме последних keep_last_messages, и возвращает их для сжатия."""
+        session = self.get_or_create_session(user_id)
+        history = session.conversation_history
+        if len(history) <= self.keep_last_messages:
+            return []
+        if sum(msg.tokens for msg in history) <= self.history_token_budget:
+            return []
+
+        overflow = []
+        for _ in range(len(history) - self.keep_last_messages):
+            msg = history.popleft()
+            overflow.append({"role": msg.role, "content": msg.content})
+        self._touch(session)
+        return overflow
+
+    def get_summary(self, user_id: int) -> str:
+        session = self.get_or_create_session(user_id)
+        return session.summary
+
+    def set_summary(self, user_id: int, summary: str) -> None:
+        session = self.get_or_create_session(user_id)
+        set_session_summary(session, summary)
+        self._touch(session)
 
     def update_preferences(self, user_id: int, preferences: UserPreferences) -> None:
         session = self.get_or_create_session(user_id)
         session.preferences = preferences
-        session.updated_at = datetime.now()
+        self._invalidate_prefetch(session)
+        self._touch(session)
 
     def set_location(self, user_id: int, latitude: float, longitude: float) -> None:
         session = self.get_or_create_session(user_id)
         session.current_location = {"lat": latitude, "lon": longitude}
-        session.updated_at = datetime.now()
+        self._invalidate_prefetch(session)
+        self._touch(session)
+
+    def set_prefetch(self, user_id: int, task: asyncio.Task) -> None:
+        """Запоминает фоновый поиск для текущих предпочтений и локации пользователя."""
+        session = self.get_or_create_session(user_id)
+        self._cancel_prefetch(session)
+        session.prefetch_key = self._prefetch_key(session)
+        session.prefetch_task = task
+
+    def pop_prefetch(self, user_id: int) -> Optional[asyncio.Task]:
+        """Забирает фоновый поиск, если он запущен для актуальных предпочтений."""
+        session = self.get_or_create_session(user_id)
+        task = session.prefetch_task
+        if task is None or session.prefetch_key != self._prefetch_key(session):
+            self._cancel_prefetch(session)
+            return None
+        session.prefetch_key = None
+        session.prefetch_task = None
+        return task
+
+    def update_search_results(self, user_id: int, places: List[Place], has_more_pages: bool = False) -> None:
+        session = self.get_or_create_session(user_id)
+        self._cancel_next_page(session)
+        session.last_search_results = tuple(places)
+        session.result_offset = 0
+        session.result_page = 1
+        session.has_more_pages = has_more_pages
+        self._touch(session)
+
+    def extend_search_results(self, user_id: int, places: List[Place], page: int, has_more_pages: bool) -> None:
+        """Дописывает в окно результаты следующей страницы, пропуская уже известные места."""
+        session = self.get_or_create_session(user_id)
+        known = {place.id for place in session.last_search_results}
+        session.last_search_results += tuple(place for place in places if place.id not in known)
+        session.result_page = page
+        session.has_more_pages = has_more_pages
+        self._touch(session)
 
-    def update_search_results(self, user_id: int, places: List[Place]) -> None:
+    def set_result_offset(self, user_id: int, offset: int) -> None:
         session = self.get_or_create_session(user_id)
-        session.last_search_results = places
-        session.updated_at = datetime.now()
+        session.result_offset = offset
+        self._touch(session)
+
+    def set_next_page_task(self, user_id: int, task: asyncio.Task) -> None:
+        session = self.get_or_create_session(user_id)
+        self._cancel_next_page(session)
+        session.next_page_task = task
 
     def clear_session(self, user_id: int) -> None:
         if user_id in self.sessions:
-            del self.sessions[user_id]
+            session = self.sessions.pop(user_id)
+            self._cancel_prefetch(session)
+            self._cancel_next_page(session)
+        self._dirty.discard(user_id)
+        if self.storage is not None:
+            self._pending[user_id] = None
 
     def get_session_state(self, user_id: int) -> str:
         session = self.get_or_create_session(user_id)
@@ -83,8 +376,119 @@ class UserStateManager:
     def set_session_state(self, user_id: int, state: str) -> None:
         session = self.get_or_create_session(user_id)
         session.state = state
-        session.updated_at = datetime.now()
+        self._touch(session)
+
+    def evict_sessions(self, reserve: int = 0) -> int:
+        """Удаляет неактивные дольше idle_ttl сессии и самые старые сверх max_sessions.
+
+        reserve - сколько мест нужно освободить под новые сессии.
+        """
+        evicted = 0
+        deadline = time.time() - self.idle_ttl
+        while self.sessions:
+            user_id, oldest = next(iter(self.sessions.items()))
+            if oldest.updated_at >= deadline and len(self.sessions) + reserve <= self.max_sessions:
+                break
+            self._evict(user_id)
+            evicted += 1
+        self.evicted_count += evicted
+        return evicted
+
+    def memory_report(self, sample_size: int = 200) -> Dict[str, int]:
+        """Оценка памяти сессий по выборке последних активных сессий."""
+        count = len(self.sessions)
+        sample = list(islice(reversed(self.sessions.values()), sample_size))
+        sample_bytes = sum(_deep_getsizeof(session, set()) for session in sample)
+        per_session = sample_bytes // len(sample) if sample else 0
+        return {
+            "sessions": count,
+            "created": self.created_count,
+            "evicted": self.evicted_count,
+            "bytes_per_session": per_session,
+            "estimated_bytes": per_session * count
+        }
+
+    def _add_session(self, session: UserSession) -> UserSession:
+        self.evict_sessions(reserve=1)
+        self.sessions[session.user_id] = session
+        self.created_count += 1
+        if self.memory_report_every and self.created_count % self.memory_report_every == 0:
+            logging.info(f"Session memory report: {self.memory_report()}")
+        return session
+
+    def _load_session(self, user_id: int) -> UserSession:
+        # Обновления пользователей уже подгружены preload_session; синхронное чтение
+        # остается для фоновых задач, чья сессия успела вытесниться
+        if self.storage is not None:
+            if user_id in self._pending:
+                data = self._pending[user_id]
+            elif user_id in self._inflight:
+                data = self._inflight[user_id]
+            else:
+                try:
+                    data = self.storage.load(user_id)
+                except Exception as e:
+                    logging.error(f"Error loading session {user_id}: {e}")
+                    data = None
+            if data is not None:
+                return session_from_dict(data, self.history_size)
+        return UserSession(user_id=user_id, history_size=self.history_size)
+
+    def _evict(self, user_id: int) -> None:
+        session = self.sessions.pop(user_id)
+        self._cancel_prefetch(session)
+        self._cancel_next_page(session)
+        # В хранилище уходит только текущая страница и ближайшие непросмотренные места
+        offset = session.result_offset
+        if offset or len(session.last_search_results) > self.evicted_window_size:
+            session.last_search_results = session.last_search_results[offset:offset + self.evicted_window_size]
+            session.result_offset = 0
+            self._dirty.add(user_id)
+        if user_id in self._dirty:
+            self._dirty.discard(user_id)
+            if self.storage is not None:
+                self._pending[user_id] = session_to_dict(session)
+
+    @staticmethod
+    def _prefetch_key(session: UserSession) -> Tuple:
+        location = session.current_location
+        return (
+            preferences_key(session.preferences),
+            (location["lat"], location["lon"]) if location else None
+        )
+
+    def _invalidate_prefetch(self, session: UserSession) -> None:
+        if session.prefetch_task is not None and session.prefetch_key != self._prefetch_key(session):
+            self._cancel_prefetch(session)
+
+    @staticmethod
+    def _cancel_prefetch(session: UserSession) -> None:
+        if session.prefetch_task is not None:
+            session.prefetch_task.cancel()
+        session.prefetch_key = None
+        session.prefetch_task = None
+
+    @staticmethod
+    def _cancel_next_page(session: UserSession) -> None:
+        if session.next_page_task is not None:
+            session.next_page_task.cancel()
+        session.next_page_task = None
+
+    def _touch(self, session: UserSession) -> None:
+        session.updated_at = time.time()
+        if session.user_id in self.sessions:
+            self.sessions.move_to_end(session.user_id)
+            self._dirty.add(session.user_id)
 
 
 # Глобальный менеджер состояний
-state_manager = UserStateManager() 
\ No newline at end of file
+state_manager = UserStateManager(
+    max_sessions=settings.state.max_sessions,
+    idle_ttl=settings.state.idle_ttl,
+    history_size=settings.state.history_size,
+    memory_report_every=settings.state.memory_report_every,
+    storage=SQLiteStorage(settings.state.storage_path) if settings.state.storage_path else None,
+    flush_interval=settings.state.flush_interval,
+    history_token_budget=settings.state.history_token_budget,
+    keep_last_messages=settings.state.keep_last_messages
+)
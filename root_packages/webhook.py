@@ -0,0 +1,196 @@
+import ssl
+import signal
+import asyncio
+import logging
+from typing import List, Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import FSInputFile, Update
+
+
+class WebhookServer:
+    """aiohttp-приложение, принимающее обновления Telegram через webhook.
+
+    Каждое обновление обрабатывается отдельной задачей, как в polling с
+    handle_as_tasks: параллелизм ограничивает UserQueueMiddleware, а не пул
+    воркеров, который простаивал бы на блокировке пользователя. Принятых,
+    но не обработанных обновлений не больше queue_size; сверх этого Telegram
+    получает 503 и повторит доставку позже.
+    """
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        path: str = "/webhook",
+        health_path: str = "/health",
+        secret_token: str = "",
+        queue_size: int = 1000
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.health_path = health_path
+        self.secret_token = secret_token
+        self.queue_size = queue_size
+        self._tasks: Set[asyncio.Task] = set()
+        self._accepting = True
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get(health_path, self.health)
+        self.app.on_startup.append(self._on_startup)
+        self.app.on_shutdown.append(self._on_shutdown)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+
+        if not self._accepting or len(self._tasks) >= self.queue_size:
+            logging.warning("Too many pending webhook updates, asking Telegram to retry")
+            return web.Response(status=503)
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        status = 200 if self._accepting else 503
+        return web.json_response(
+            {"status": "ok" if status == 200 else "stopping", "pending": len(self._tasks)},
+            status=status
+        )
+
+    async def _process(self, update: Update) -> None:
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logging.error(f"Error processing webhook update {update.update_id}: {e}")
+
+    async def _on_startup(self, app: web.Application) -> None:
+        await self.dp.emit_startup(bot=self.bot)
+
+    async def _on_shutdown(self, app: web.Application) -> None:
+        # Даем дообработать принятые обновления
+        self._accepting = False
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=10)
+            if pending:
+                logging.warning(f"Dropping {len(pending)} unprocessed webhook updates")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        await self.dp.emit_shutdown(bot=self.bot)
+
+
+def load_ssl_context(cert_path: str, key_path: str) -> Optional[ssl.SSLContext]:
+    if not (cert_path and key_path):
+        return None
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(cert_path, key_path)
+    return ssl_context
+
+
+async def register_webhook(
+    bot: Bot,
+    base_url: str,
+    path: str,
+    allowed_updates: List[str],
+    secret_token: str = "",
+    cert_path: str = ""
+) -> None:
+    await bot.set_webhook(
+        url=base_url.rstrip("/") + path,
+        certificate=FSInputFile(cert_path) if cert_path else None,
+        secret_token=secret_token or None,
+        allowed_updates=allowed_updates
+    )
+
+
+async def serve_app(
+    app: web.Application,
+    host: str,
+    port: int,
+    ssl_context: Optional[ssl.SSLContext] = None,
+    stop: Optional[asyncio.Event] = None
+) -> None:
+    """Обслуживает aiohttp-приложение до установки stop или отмены."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+    await site.start()
+    logging.info(f"HTTP server listening on {host}:{port}")
+
+    try:
+        await (stop or asyncio.Event()).wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    base_url: str,
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    path: str = "/webhook",
+    health_path: str = "/health",
+    secret_token: str = "",
+    cert_path: str = "",
+    key_path: str = "",
+    queue_size: int = 1000
+) -> None:
+    """Регистрирует webhook в Telegram и обслуживает его до отмены.
+
+    С cert_path/key_path сервер сам принимает HTTPS и передает Telegram
+    самоподписанный сертификат; без них ожидается, что TLS завершает прокси.
+    """
+    server = WebhookServer(
+        dp, bot,
+        path=path,
+        health_path=health_path,
+        secret_token=secret_token,
+        queue_size=queue_size
+    )
+
+    await register_webhook(bot, base_url, path, dp.resolve_used_update_types(), secret_token, cert_path)
+    try:
+        await serve_app(server.app, host, port, load_ssl_context(cert_path, key_path))
+    finally:
+        await bot.session.close()
+
+
+async def run_shard_worker(
+    dp: Dispatcher,
+    bot: Bot,
+    port: int,
+    path: str = "/webhook",
+    health_path: str = "/health",
+    secret_token: str = "",
+    queue_size: int = 1000
+) -> None:
+    """Воркер шарда: принимает обновления от супервизора на локальном порту.
+
+    SIGTERM от супервизора завершает сервер штатно, с dp.emit_shutdown.
+    """
+    server = WebhookServer(
+        dp, bot,
+        path=path,
+        health_path=health_path,
+        secret_token=secret_token,
+        queue_size=queue_size
+    )
+
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        await serve_app(server.app, "127.0.0.1", port, stop=stop)
+    finally:
+        await bot.session.close()
@@ -8,17 +8,175 @@ load_dotenv()
 @dataclass
 class Bot:
     bot_token: str
+    # Потоковые ответы: интервал между правками сообщения и размер первого фрагмента
+    stream_edit_interval: float = 1.0
+    stream_first_chunk_chars: int = 40
 
 
 @dataclass
 class OpenAI:
     api_key: str
     model: str = "gpt-4.1-mini"
+    # Один структурированный запрос на ход диалога вместо анализа + вопроса
+    combined_turn: bool = True
+    stream_questions: bool = True
+    # Локальный разбор простых ответов перед обращением к LLM
+    local_extractor: bool = True
+    # Модель для сжатия истории; пустая строка - содержание собирается локально
+    summary_model: str = ""
+    # Клиентские лимиты (0 - без ограничения) и повторы с экспоненциальной задержкой
+    requests_per_minute: int = 500
+    tokens_per_minute: int = 200_000
+    max_concurrency: int = 32
+    min_concurrency: int = 2
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 20.0
+    # Таймаут одной попытки и общий срок вызова с повторами, в секундах
+    timeout: float = 20.0
+    deadline: float = 45.0
+    # Circuit breaker: доля неудач в окне, "медленный" ответ и время в открытом состоянии
+    breaker_failure_ratio: float = 0.5
+    breaker_slow_call: float = 15.0
+    breaker_open_duration: float = 30.0
+    # Дублирование медленных запросов после p95 задержки (кроме потоковых)
+    hedge: bool = False
+    hedge_min_delay: float = 2.0
 
 
 @dataclass
 class GIS:
     api_key: str
+    connection_limit: int = 100
+    connection_limit_per_host: int = 30
+    keepalive_timeout: float = 30.0
+    dns_cache_ttl: int = 300
+    cache_ttl: float = 600.0
+    cache_max_entries: int = 5000
+    cache_max_bytes: int = 0
+    cache_geohash_precision: int = 6
+    requests_per_minute: int = 600
+    max_concurrency: int = 16
+    min_concurrency: int = 2
+    max_retries: int = 2
+    backoff_base: float = 0.3
+    backoff_max: float = 5.0
+    timeout: float = 5.0
+    deadline: float = 12.0
+    breaker_failure_ratio: float = 0.5
+    breaker_slow_call: float = 3.0
+    breaker_open_duration: float = 20.0
+    hedge: bool = False
+    hedge_min_delay: float = 0.3
+    # Параллельные варианты запроса, их общее число на поиск и сколько мест достаточно для досрочного ответа
+    planner_max_parallel: int = 3
+    planner_max_variants: int = 3
+    planner_enough_results: int = 5
+    # Локальный индекс мест: размер, ячейка сетки в градусах и снимки на диск
+    index_max_places: int = 50_000
+    index_cell_deg: float = 0.01
+    index_snapshot_path: str = ""
+    index_snapshot_interval: float = 300.0
+    # Отвечать из индекса без запроса, если он уже покрывает поиск
+    index_serve_covered: bool = False
+    # Популярные места по тайлам geohash: обновление в фоне в пределах бюджета запросов
+    popular_enabled: bool = True
+    popular_precision: int = 5
+    popular_refresh_interval: float = 1800.0
+    popular_tile_ttl: float = 21600.0
+    popular_max_tiles: int = 500
+    popular_refresh_per_minute: float = 6.0
+
+
+@dataclass
+class Ranking:
+    # Сколько кандидатов запрашивать у 2ГИС для локального переранжирования
+    candidate_pool: int = 30
+    rating_weight: float = 1.0
+    reviews_weight: float = 0.5
+    distance_weight: float = 1.0
+    relevance_weight: float = 1.5
+    distance_scale_km: float = 1.5
+
+
+@dataclass
+class State:
+    max_sessions: int = 100_000
+    idle_ttl: float = 6 * 3600
+    history_size: int = 50
+    memory_report_every: int = 10_000
+    # Путь к SQLite-базе сессий; пустая строка - хранить сессии только в памяти
+    storage_path: str = ""
+    flush_interval: float = 2.0
+    # Бюджет токенов истории в промпте и сколько последних реплик не сворачивать
+    history_token_budget: int = 1200
+    keep_last_messages: int = 4
+
+
+@dataclass
+class Concurrency:
+    # Общее число одновременно обрабатываемых обновлений
+    max_in_flight: int = 64
+    # Сколько необработанных обновлений одного пользователя допускается
+    max_user_queue: int = 3
+    # Длина общей очереди, после которой новые обновления отклоняются
+    max_waiting: int = 1000
+
+
+@dataclass
+class Webhook:
+    # polling - long polling, webhook - aiohttp-сервер для обновлений
+    mode: str = "polling"
+    base_url: str = ""
+    path: str = "/webhook"
+    health_path: str = "/health"
+    host: str = "0.0.0.0"
+    port: int = 8080
+    secret_token: str = ""
+    # Самоподписанный сертификат; без него TLS должен завершать прокси
+    cert_path: str = ""
+    key_path: str = ""
+    # Принятые, но еще не обработанные обновления; сверх этого Telegram получает 503
+    queue_size: int = 1000
+
+
+@dataclass
+class Sharding:
+    # Больше одного - процесс-супервизор раздает обновления воркерам по хэшу user_id
+    workers: int = 0
+    # Воркер i слушает 127.0.0.1:(base_port + i)
+    base_port: int = 8100
+    heartbeat_interval: float = 2.0
+    heartbeat_timeout: float = 10.0
+    # Сколько ждать первого ответа health от нового воркера
+    startup_timeout: float = 60.0
+    # Задержка перед перезапуском удваивается при повторных падениях до restart_delay_max
+    restart_delay: float = 1.0
+    restart_delay_max: float = 30.0
+    queue_size: int = 1000
+    # Запасной буфер шарда в режиме polling, пока воркер недоступен
+    overflow_size: int = 10000
+
+
+@dataclass
+class Metrics:
+    # Эндпоинт Prometheus; по умолчанию слушает только локальный интерфейс
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9090
+    path: str = "/metrics"
+    loop_lag_interval: float = 0.5
+
+
+@dataclass
+class Outbound:
+    # Очередь исходящих запросов к Telegram: общий лимит в секунду и лимиты на чат
+    enabled: bool = True
+    global_rate: float = 30.0
+    chat_rate: float = 1.0
+    group_rate_per_minute: float = 20.0
+    # Сколько запросов подряд чат отправляет без ожидания, прежде чем действует chat_rate
+    chat_burst: int = 3
 
 
 @dataclass
@@ -26,19 +184,141 @@ class Settings:
     bot: Bot
     openai: OpenAI
     gis: GIS
+    ranking: Ranking
+    state: State
+    concurrency: Concurrency
+    webhook: Webhook
+    sharding: Sharding
+    metrics: Metrics
+    outbound: Outbound
 
 
 def get_settings(path: str):
     return Settings(
         bot=Bot(
             bot_token=getenv("TELEGRAM_BOT_TOKEN"),
+            stream_edit_interval=float(getenv("BOT_STREAM_EDIT_INTERVAL", "1.0")),
+            stream_first_chunk_chars=int(getenv("BOT_STREAM_FIRST_CHUNK_CHARS", "40"))
         ),
         openai=OpenAI(
             api_key=getenv("OPENAI_API_KEY"),
-            model=getenv("OPENAI_MODEL", "gpt-4.1-mini")
+            model=getenv("OPENAI_MODEL", "gpt-4.1-mini"),
+            combined_turn=getenv("OPENAI_COMBINED_TURN", "true").lower() == "true",
+            stream_questions=getenv("OPENAI_STREAM_QUESTIONS", "true").lower() == "true",
+            local_extractor=getenv("OPENAI_LOCAL_EXTRACTOR", "true").lower() == "true",
+            summary_model=getenv("OPENAI_SUMMARY_MODEL", ""),
+            requests_per_minute=int(getenv("OPENAI_REQUESTS_PER_MINUTE", "500")),
+            tokens_per_minute=int(getenv("OPENAI_TOKENS_PER_MINUTE", "200000")),
+            max_concurrency=int(getenv("OPENAI_MAX_CONCURRENCY", "32")),
+            min_concurrency=int(getenv("OPENAI_MIN_CONCURRENCY", "2")),
+            max_retries=int(getenv("OPENAI_MAX_RETRIES", "3")),
+            backoff_base=float(getenv("OPENAI_BACKOFF_BASE", "0.5")),
+            backoff_max=float(getenv("OPENAI_BACKOFF_MAX", "20")),
+            timeout=float(getenv("OPENAI_TIMEOUT", "20")),
+            deadline=float(getenv("OPENAI_DEADLINE", "45")),
+            breaker_failure_ratio=float(getenv("OPENAI_BREAKER_FAILURE_RATIO", "0.5")),
+            breaker_slow_call=float(getenv("OPENAI_BREAKER_SLOW_CALL", "15")),
+            breaker_open_duration=float(getenv("OPENAI_BREAKER_OPEN_DURATION", "30")),
+            hedge=getenv("OPENAI_HEDGE", "false").lower() == "true",
+            hedge_min_delay=float(getenv("OPENAI_HEDGE_MIN_DELAY", "2"))
         ),
         gis=GIS(
-            api_key=getenv("GIS_API_KEY", "")
+            api_key=getenv("GIS_API_KEY", ""),
+            connection_limit=int(getenv("GIS_CONNECTION_LIMIT", "100")),
+            connection_limit_per_host=int(getenv("GIS_CONNECTION_LIMIT_PER_HOST", "30")),
+            keepalive_timeout=float(getenv("GIS_KEEPALIVE_TIMEOUT", "30")),
+            dns_cache_ttl=int(getenv("GIS_DNS_CACHE_TTL", "300")),
+            cache_ttl=float(getenv("GIS_CACHE_TTL", "600")),
+            cache_max_entries=int(getenv("GIS_CACHE_MAX_ENTRIES", "5000")),
+            cache_max_bytes=int(getenv("GIS_CACHE_MAX_BYTES", "0")),
+            cache_geohash_precision=int(getenv("GIS_CACHE_GEOHASH_PRECISION", "6")),
+            requests_per_minute=int(getenv("GIS_REQUESTS_PER_MINUTE", "600")),
+            max_concurrency=int(getenv("GIS_MAX_CONCURRENCY", "16")),
+            min_concurrency=int(getenv("GIS_MIN_CONCURRENCY", "2")),
+            max_retries=int(getenv("GIS_MAX_RETRIES", "2")),
+            backoff_base=float(getenv("GIS_BACKOFF_BASE", "0.3")),
+            backoff_max=float(getenv("GIS_BACKOFF_MAX", "5")),
+            timeout=float(getenv("GIS_TIMEOUT", "5")),
+            deadline=float(getenv("GIS_DEADLINE", "12")),
+            breaker_failure_ratio=float(getenv("GIS_BREAKER_FAILURE_RATIO", "0.5")),
+            breaker_slow_call=float(getenv("GIS_BREAKER_SLOW_CALL", "3")),
+            breaker_open_duration=float(getenv("GIS_BREAKER_OPEN_DURATION", "20")),
+            hedge=getenv("GIS_HEDGE", "false").lower() == "true",
+            hedge_min_delay=float(getenv("GIS_HEDGE_MIN_DELAY", "0.3")),
+            planner_max_parallel=int(getenv("GIS_PLANNER_MAX_PARALLEL", "3")),
+            planner_max_variants=int(getenv("GIS_PLANNER_MAX_VARIANTS", "3")),
+            planner_enough_results=int(getenv("GIS_PLANNER_ENOUGH_RESULTS", "5")),
+            index_max_places=int(getenv("GIS_INDEX_MAX_PLACES", "50000")),
+            index_cell_deg=float(getenv("GIS_INDEX_CELL_DEG", "0.01")),
+            index_snapshot_path=getenv("GIS_INDEX_SNAPSHOT_PATH", ""),
+            index_snapshot_interval=float(getenv("GIS_INDEX_SNAPSHOT_INTERVAL", "300")),
+            index_serve_covered=getenv("GIS_INDEX_SERVE_COVERED", "false").lower() == "true",
+            popular_enabled=getenv("GIS_POPULAR_ENABLED", "true").lower() == "true",
+            popular_precision=int(getenv("GIS_POPULAR_PRECISION", "5")),
+            popular_refresh_interval=float(getenv("GIS_POPULAR_REFRESH_INTERVAL", "1800")),
+            popular_tile_ttl=float(getenv("GIS_POPULAR_TILE_TTL", "21600")),
+            popular_max_tiles=int(getenv("GIS_POPULAR_MAX_TILES", "500")),
+            popular_refresh_per_minute=float(getenv("GIS_POPULAR_REFRESH_PER_MINUTE", "6"))
+        ),
+        ranking=Ranking(
+            candidate_pool=int(getenv("RANKING_CANDIDATE_POOL", "30")),
+            rating_weight=float(getenv("RANKING_RATING_WEIGHT", "1.0")),
+            reviews_weight=float(getenv("RANKING_REVIEWS_WEIGHT", "0.5")),
+            distance_weight=float(getenv("RANKING_DISTANCE_WEIGHT", "1.0")),
+            relevance_weight=float(getenv("RANKING_RELEVANCE_WEIGHT", "1.5")),
+            distance_scale_km=float(getenv("RANKING_DISTANCE_SCALE_KM", "1.5"))
+        ),
+        state=State(
+            max_sessions=int(getenv("STATE_MAX_SESSIONS", "100000")),
+            idle_ttl=float(getenv("STATE_IDLE_TTL", "21600")),
+            history_size=int(getenv("STATE_HISTORY_SIZE", "50")),
+            memory_report_every=int(getenv("STATE_MEMORY_REPORT_EVERY", "10000")),
+            storage_path=getenv("STATE_DB_PATH", ""),
+            flush_interval=float(getenv("STATE_FLUSH_INTERVAL", "2.0")),
+            history_token_budget=int(getenv("STATE_HISTORY_TOKEN_BUDGET", "1200")),
+            keep_last_messages=int(getenv("STATE_KEEP_LAST_MESSAGES", "4"))
+        ),
+        concurrency=Concurrency(
+            max_in_flight=int(getenv("MAX_IN_FLIGHT", "64")),
+            max_user_queue=int(getenv("MAX_USER_QUEUE", "3")),
+            max_waiting=int(getenv("MAX_WAITING_UPDATES", "1000"))
+        ),
+        webhook=Webhook(
+            mode=getenv("BOT_MODE", "polling"),
+            base_url=getenv("WEBHOOK_BASE_URL", ""),
+            path=getenv("WEBHOOK_PATH", "/webhook"),
+            health_path=getenv("WEBHOOK_HEALTH_PATH", "/health"),
+            host=getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(getenv("WEBHOOK_PORT", "8080")),
+            secret_token=getenv("WEBHOOK_SECRET_TOKEN", ""),
+            cert_path=getenv("WEBHOOK_CERT_PATH", ""),
+            key_path=getenv("WEBHOOK_KEY_PATH", ""),
+            queue_size=int(getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+        ),
+        sharding=Sharding(
+            workers=int(getenv("SHARD_WORKERS", "0")),
+            base_port=int(getenv("SHARD_BASE_PORT", "8100")),
+            heartbeat_interval=float(getenv("SHARD_HEARTBEAT_INTERVAL", "2")),
+            heartbeat_timeout=float(getenv("SHARD_HEARTBEAT_TIMEOUT", "10")),
+            startup_timeout=float(getenv("SHARD_STARTUP_TIMEOUT", "60")),
+            restart_delay=float(getenv("SHARD_RESTART_DELAY", "1")),
+            restart_delay_max=float(getenv("SHARD_RESTART_DELAY_MAX", "30")),
+            queue_size=int(getenv("SHARD_QUEUE_SIZE", "1000")),
+            overflow_size=int(getenv("SHARD_OVERFLOW_SIZE", "10000"))
+        ),
+        metrics=Metrics(
+            enabled=getenv("METRICS_ENABLED", "false").lower() == "true",
+            host=getenv("METRICS_HOST", "127.0.0.1"),
+            port=int(getenv("METRICS_PORT", "9090")),
+            path=getenv("METRICS_PATH", "/metrics"),
+            loop_lag_interval=float(getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))
+        ),
+        outbound=Outbound(
+            enabled=getenv("OUTBOUND_ENABLED", "true").lower() == "true",
+            global_rate=float(getenv("OUTBOUND_GLOBAL_RATE", "30")),
+            chat_rate=float(getenv("OUTBOUND_CHAT_RATE", "1")),
+            group_rate_per_minute=float(getenv("OUTBOUND_GROUP_RATE_PER_MINUTE", "20")),
+            chat_burst=int(getenv("OUTBOUND_CHAT_BURST", "3"))
         )
     )
 
@@ -0,0 +1,53 @@
+"""Регрессионные фразы для локального разбора предпочтений (PreferenceExtractor).
+
+Фразы, на которых правила раньше давали уверенный, но неверный ответ, и
+ожидаемый результат extract. Прогон падает с кодом 1 при любом расхождении:
+    python -m tools.extractor_cases
+"""
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from root_packages.api.preference_extractor import PreferenceExtractor
+
+
+CASES: List[Tuple[str, Optional[Dict]]] = [
+    # Открытые окончания совпадали с однокоренными словами без предпочтений
+    ("хочу на вечеринку", None),
+    ("ночлег", None),
+    ("дневник", None),
+    ("утренник", None),
+    ("в дорогу", None),
+    ("кафедра", None),
+    ("кинолог", None),
+    ("салон", None),
+    ("спортсмен", None),
+    ("музейщик", None),
+    # Обычные формы по-прежнему распознаются
+    ("вечером", {"time_preference": "вечером", "specific_requirements": []}),
+    ("ночью", {"time_preference": "ночью", "specific_requirements": []}),
+    ("днём", {"time_preference": "днем", "specific_requirements": []}),
+    ("в кинотеатре", {"category": "развлечения", "specific_requirements": []}),
+    ("салон красоты", None),
+    ("красоты", {"category": "красота", "specific_requirements": []}),
+    ("в музей", {"category": "культура", "specific_requirements": []}),
+    ("дорогой ресторан", {"price_range": "премиум", "category": "ресторан", "specific_requirements": []}),
+    ("недорогое кафе утром", {
+        "price_range": "бюджетно", "category": "кафе", "time_preference": "утром", "specific_requirements": []
+    }),
+]
+
+
+def main() -> int:
+    extractor = PreferenceExtractor()
+    failures = 0
+    for phrase, expected in CASES:
+        actual = extractor.extract(phrase)
+        if actual != expected:
+            failures += 1
+            print(f"{phrase!r}: ожидалось {expected}, получено {actual}")
+    print(f"{len(CASES) - failures}/{len(CASES)} фраз разобраны верно")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
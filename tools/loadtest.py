@@ -0,0 +1,498 @@
+"""Нагрузочный тест бота без внешних сервисов.
+
+Telegram Bot API, OpenAI и каталог 2ГИС заменяются локальными aiohttp-серверами
+с настраиваемой задержкой и долей ошибок. Синтетические пользователи проходят
+полный диалог (/start, геопозиция, ответы на вопросы, поиск, "ещё варианты"),
+обновления подаются прямо в dp.feed_update. В конце печатаются пропускная
+способность, перцентили задержки обработки, задержка event loop и RSS.
+
+Заглушки работают в том же процессе и event loop, что и бот, поэтому их
+(небольшая) стоимость входит в результаты. Лимиты Upstream берутся из обычных
+настроек: чтобы измерить сам бот, а не квоты, поднимите OPENAI_REQUESTS_PER_MINUTE,
+GIS_REQUESTS_PER_MINUTE и т.п.
+
+Запуск из корня репозитория:
+    python -m tools.loadtest --users 1000 --concurrency 200 --openai-latency 0.8
+"""
+import os
+
+# Настройки читаются при импорте модулей бота, поэтому окружение задается до импорта
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:loadtest")
+os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+os.environ.setdefault("GIS_API_KEY", "loadtest")
+os.environ.setdefault("STATE_DB_PATH", "")
+os.environ.setdefault("GIS_INDEX_SNAPSHOT_PATH", "")
+
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import openai
+from aiogram import Bot, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+from main import on_startup, on_shutdown
+from root_packages.handlers.akinator_handler import dp, gis_client, openai_client
+from root_packages.root import create_bot
+from settings import settings
+
+
+ANSWERS = [
+    "кафе",
+    "недорого вечером",
+    "хочу поужинать в ресторане с верандой",
+    "что-нибудь для отдыха с друзьями на выходных",
+    "кофейня с хорошим десертом и wifi",
+    "средний чек, можно с детьми",
+    "бар с живой музыкой ночью",
+]
+
+QUESTIONS = [
+    "Какой тип заведения тебе больше по душе?",
+    "На какой бюджет ориентируемся?",
+    "В какое время планируешь выбраться?",
+    "Есть ли особые пожелания к месту?",
+]
+
+RUBRICS = ["Кафе", "Рестораны", "Кофейни", "Бары", "Кинотеатры", "Музеи", "Фитнес-клубы", "Торговые центры"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # Вне Linux доступен только пиковый RSS
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class StubServer:
+    """Локальный HTTP-сервер с искусственной задержкой и ошибками."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.app = web.Application()
+        self.requests = 0
+        self.errors = 0
+        self._runner: Optional[web.AppRunner] = None
+        self._port = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._port}"
+
+    async def start(self) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self._port = sock.getsockname()[1]
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.SockSite(self._runner, sock).start()
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def delay(self, scale: float = 1.0) -> None:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * scale * random.uniform(0.5, 1.5))
+
+    def should_fail(self) -> bool:
+        self.requests += 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+class FakeTelegram(StubServer):
+    """Bot API: принимает исходящие сообщения и запоминает последние кнопки в чате."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(latency, error_rate)
+        self.app.router.add_post("/{bot}/{method}", self.handle)
+        self.markups: Dict[int, str] = {}
+        self.methods: Dict[str, int] = {}
+        self.error_replies = 0
+        self._message_id = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        await self.delay()
+        if self.should_fail():
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            })
+
+        self.methods[method] = self.methods.get(method, 0) + 1
+        if method not in ("sendMessage", "editMessageText"):
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(data.get("chat_id", 0))
+        text = str(data.get("text", ""))
+        self.markups[chat_id] = str(data.get("reply_markup", ""))
+        if "ошибка" in text.lower():
+            self.error_replies += 1
+
+        self._message_id += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": int(data.get("message_id", self._message_id)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text
+        }})
+
+
+class FakeOpenAI(StubServer):
+    """Chat Completions: вопросы (в том числе потоком) и JSON с предпочтениями."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, complete_prob: float = 0.4):
+        super().__init__(latency, error_rate)
+        self.complete_prob = complete_prob
+        self.app.router.add_post("/v1/chat/completions", self.handle)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if self.should_fail():
+            await self.delay(0.2)
+            return web.json_response({"error": {"message": "stub failure", "type": "server_error"}}, status=500)
+
+        if body.get("response_format", {}).get("type") == "json_object":
+            result: Dict = {"preferences": self._preferences()}
+            if '"question"' in body["messages"][0]["content"]:
+                result["question"] = random.choice(QUESTIONS)
+            else:
+                result = result["preferences"]
+            content = json.dumps(result, ensure_ascii=False)
+        else:
+            content = random.choice(QUESTIONS)
+
+        if body.get("stream"):
+            return await self._stream(request, body["model"], content)
+
+        await self.delay()
+        return web.json_response({
+            "id": "chatcmpl-loadtest",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+        })
+
+    async def _stream(self, request: web.Request, model: str, content: str) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = content.split(" ")
+        # Первый токен приходит примерно через треть общей задержки, остальное - равными порциями
+        await self.delay(1 / 3)
+        for i in range(0, len(words), 3):
+            chunk = {
+                "id": "chatcmpl-loadtest",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": " ".join(words[i:i + 3]) + " "}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await self.delay(2 / 3 / max(1, len(words) // 3))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _preferences(self) -> Dict:
+        if random.random() < self.complete_prob:
+            return {
+                "category": "кафе",
+                "price_range": "средний",
+                "activity_type": "еда",
+                "time_preference": "вечером",
+                "specific_requirements": ["веранда"]
+            }
+        return {random.choice(["category", "price_range"]): random.choice(["кафе", "бюджетно"])}
+
+
+class FakeGIS(StubServer):
+    """Каталог 2ГИС: детерминированные места вокруг точки поиска."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, total: int = 200):
+        super().__init__(latency, error_rate)
+        self.total = total
+        self.app.router.add_get("/3.0/items", self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        await self.delay()
+        if self.should_fail():
+            return web.json_response({"meta": {"code": 503}}, status=503)
+
+        params = request.query
+        page = int(params.get("page", 1))
+        page_size = int(params.get("page_size", 10))
+        lon, lat = (float(value) for value in params.get("point", "37.62,55.75").split(","))
+        rng = random.Random(f"{params.get('q')}|{params.get('point')}|{page}")
+
+        start = (page - 1) * page_size
+        items = [self._item(rng, f"{abs(hash(params.get('q')))}_{start + i}", lat, lon)
+                 for i in range(max(0, min(page_size, self.total - start)))]
+        return web.json_response({"meta": {"code": 200}, "result": {"total": self.total, "items": items}})
+
+    @staticmethod
+    def _item(rng: random.Random, place_id: str, lat: float, lon: float) -> Dict:
+        return {
+            "id": place_id,
+            "name": f"Место {place_id}",
+            "address_name": f"ул. Тестовая, {rng.randint(1, 200)}",
+            "point": {"lat": lat + rng.uniform(-0.02, 0.02), "lon": lon + rng.uniform(-0.03, 0.03)},
+            "rubrics": [{"name": name} for name in rng.sample(RUBRICS, 2)],
+            "reviews": {"rating": round(rng.uniform(3.0, 5.0), 1), "count": rng.randint(0, 2000)}
+        }
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, bot: Bot, telegram: FakeTelegram):
+        self.args = args
+        self.bot = bot
+        self.telegram = telegram
+        self.latencies: Dict[str, List[float]] = {}
+        self.loop_lag: List[float] = []
+        self.rss: List[float] = []
+        self.updates = 0
+        self.failed_updates = 0
+        self.dialogues = 0
+        self.searches = 0
+        self._update_id = 0
+
+    async def run(self) -> Dict:
+        monitor = asyncio.create_task(self._monitor())
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def user(user_id: int) -> None:
+            # Плавный набор нагрузки: пользователи приходят равномерно за ramp секунд
+            await asyncio.sleep(random.uniform(0, self.args.ramp))
+            async with semaphore:
+                await self._dialogue(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(100_000 + i) for i in range(self.args.users)))
+        elapsed = time.perf_counter() - started
+        monitor.cancel()
+        return self._report(elapsed)
+
+    async def _dialogue(self, user_id: int) -> None:
+        user = types.User(id=user_id, is_bot=False, first_name=f"User{user_id}")
+        chat = types.Chat(id=user_id, type="private")
+
+        await self._feed("start", types.Update(update_id=self._next_id(), message=self._message(user, chat, text="/start")))
+        await self._think()
+        location = types.Location(latitude=55.75 + random.uniform(-0.1, 0.1), longitude=37.62 + random.uniform(-0.1, 0.1))
+        await self._feed("location", types.Update(update_id=self._next_id(), message=self._message(user, chat, location=location)))
+
+        for _ in range(self.args.max_turns):
+            await self._think()
+            text = random.choice(ANSWERS)
+            await self._feed("answer", types.Update(update_id=self._next_id(), message=self._message(user, chat, text=text)))
+            if "start_search" in self.telegram.markups.get(user_id, ""):
+                break
+        else:
+            self.dialogues += 1
+            return
+
+        await self._think()
+        await self._feed("search", self._callback(user, chat, "start_search"))
+        self.searches += 1
+        while "more_results" in self.telegram.markups.get(user_id, "") and random.random() < self.args.more_prob:
+            await self._think()
+            await self._feed("more_results", self._callback(user, chat, "more_results"))
+        self.dialogues += 1
+
+    async def _feed(self, step: str, update: types.Update) -> None:
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.failed_updates += 1
+            logging.debug(f"Update failed: {e}")
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def _think(self) -> None:
+        if self.args.think > 0:
+            await asyncio.sleep(random.uniform(0, 2 * self.args.think))
+
+    async def _monitor(self) -> None:
+        loop = asyncio.get_running_loop()
+        interval = 0.05
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(loop.time() - started - interval)
+            self.rss.append(current_rss_mb())
+
+    def _next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _message(self, user: types.User, chat: types.Chat, **fields) -> types.Message:
+        return types.Message(message_id=self._next_id(), date=datetime.now(), chat=chat, from_user=user, **fields)
+
+    def _callback(self, user: types.User, chat: types.Chat, data: str) -> types.Update:
+        return types.Update(update_id=self._next_id(), callback_query=types.CallbackQuery(
+            id=str(self._next_id()),
+            from_user=user,
+            chat_instance=str(chat.id),
+            data=data,
+            message=types.Message(
+                message_id=self._next_id(),
+                date=datetime.now(),
+                chat=chat,
+                from_user=types.User(id=1, is_bot=True, first_name="bot"),
+                text="..."
+            )
+        ))
+
+    def _report(self, elapsed: float) -> Dict:
+        all_latencies = [value for values in self.latencies.values() for value in values]
+
+        def summary(values: List[float]) -> Dict:
+            return {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(max(values, default=0.0) * 1000, 1)
+            }
+
+        return {
+            "users": self.args.users,
+            "concurrency": self.args.concurrency,
+            "elapsed_s": round(elapsed, 2),
+            "updates": self.updates,
+            "updates_per_s": round(self.updates / elapsed, 1) if elapsed else 0.0,
+            "dialogues": self.dialogues,
+            "searches": self.searches,
+            "failed_updates": self.failed_updates,
+            "error_replies": self.telegram.error_replies,
+            "latency": summary(all_latencies),
+            "latency_by_step": {step: summary(values) for step, values in self.latencies.items()},
+            "loop_lag": {
+                "p50_ms": round(percentile(self.loop_lag, 50) * 1000, 1),
+                "p99_ms": round(percentile(self.loop_lag, 99) * 1000, 1),
+                "max_ms": round(max(self.loop_lag, default=0.0) * 1000, 1)
+            },
+            "rss_mb": {
+                "final": round(current_rss_mb(), 1),
+                "peak": round(peak_rss_mb(), 1)
+            }
+        }
+
+
+def print_report(report: Dict, stubs: Dict[str, StubServer]) -> None:
+    print(f"Пользователей: {report['users']}, одновременно: {report['concurrency']}, время: {report['elapsed_s']} с")
+    print(f"Обновлений: {report['updates']} ({report['updates_per_s']}/с), диалогов: {report['dialogues']}, "
+          f"поисков: {report['searches']}")
+    print(f"Упавших обновлений: {report['failed_updates']}, ответов с ошибкой: {report['error_replies']}")
+    print()
+    print(f"{'шаг':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, row in [("всего", report["latency"]), *report["latency_by_step"].items()]:
+        print(f"{step:<14}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print()
+    lag = report["loop_lag"]
+    print(f"Задержка event loop: p50 {lag['p50_ms']} мс, p99 {lag['p99_ms']} мс, max {lag['max_ms']} мс")
+    print(f"RSS: {report['rss_mb']['final']} МБ, пик {report['rss_mb']['peak']} МБ")
+    print("Заглушки: " + ", ".join(f"{name} {stub.requests} запросов ({stub.errors} ошибок)" for name, stub in stubs.items()))
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    stubs = {
+        "telegram": FakeTelegram(args.telegram_latency, args.telegram_error_rate),
+        "openai": FakeOpenAI(args.openai_latency, args.openai_error_rate, args.complete_prob),
+        "2gis": FakeGIS(args.gis_latency, args.gis_error_rate),
+    }
+    for stub in stubs.values():
+        await stub.start()
+
+    # Тот же конструктор, что и в боте: очередь исходящих с лимитами Telegram входит в замер
+    bot = create_bot(AiohttpSession(api=TelegramAPIServer.from_base(stubs["telegram"].url)))
+    openai_client.client = openai.AsyncOpenAI(
+        api_key=settings.openai.api_key,
+        base_url=f"{stubs['openai'].url}/v1",
+        max_retries=0
+    )
+    gis_client.base_url = f"{stubs['2gis'].url}/3.0/items"
+
+    await on_startup()
+    try:
+        report = await LoadTest(args, bot, stubs["telegram"]).run()
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+        for stub in stubs.values():
+            await stub.close()
+
+    print_report(report, stubs)
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальными заглушками API")
+    parser.add_argument("--users", type=int, default=1000, help="число синтетических диалогов")
+    parser.add_argument("--concurrency", type=int, default=200, help="одновременно активных диалогов")
+    parser.add_argument("--ramp", type=float, default=5.0, help="за сколько секунд приходят все пользователи")
+    parser.add_argument("--think", type=float, default=0.2, help="средняя пауза пользователя между шагами, с")
+    parser.add_argument("--max-turns", type=int, default=6, help="максимум ответов до предложения поиска")
+    parser.add_argument("--more-prob", type=float, default=0.5, help="вероятность нажать \"Ещё варианты\"")
+    parser.add_argument("--complete-prob", type=float, default=0.4,
+                        help="вероятность, что заглушка OpenAI вернет полный набор предпочтений")
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.8)
+    parser.add_argument("--openai-error-rate", type=float, default=0.01)
+    parser.add_argument("--gis-latency", type=float, default=0.15)
+    parser.add_argument("--gis-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", default="", help="куда сохранить отчет в JSON")
+    parser.add_argument("--log-level", default="ERROR")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, stream=sys.stderr)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()